@@ -0,0 +1,226 @@
+#
+# Feature extraction of the stored IV curves: breakdown voltage, dark current
+# at a reference overvoltage and the slope above breakdown, written to the
+# feature table of keithley_2450_db (Feature) for every entry.
+#
+# The breakdown voltage is the peak of d ln(I)/dV, refined with a parabola
+# through the peak and its neighbours. The dark current is ln(I) interpolated
+# at vbd + overvoltage, the slope a least squares line through the points at
+# least quenchStart volts above vbd.
+#
+# Curves of the same length are stacked and handled as one array, chunks of
+# entries are read and analyzed in a process pool, each worker with its own
+# database connection. Only entries without features are analyzed unless
+# --redo is given, so runs are incremental.
+#
+#     python keithley_2450_analysis.py --db sqlite:///measurements.db
+#     python keithley_2450_analysis.py --db sqlite:///measurements.db --overvoltage 2.5 --workers 8 --redo
+#
+from __future__ import print_function
+import sys,time,multiprocessing
+import argparse
+import numpy as np
+
+from keithley_2450_db import Entry, Feature, createDBEngine, CONNECT_TO_REAL_DB
+
+
+OVERVOLTAGE   = 3.0     # overvoltage of the dark current [V]
+QUENCH_START  = 1.0     # the slope is fitted from vbd + QUENCH_START on [V]
+CURRENT_FLOOR = 1e-15   # |I| below this is taken as this for the logarithm [A]
+
+
+
+# features of a stack of curves. V and I have one curve per row, V rising
+# along each row. Returns the arrays vbd, idark, slope and ok, one value per
+# curve, NaN where a feature can't be computed
+def ivFeatures(V, I, overvoltage=OVERVOLTAGE, quenchStart=QUENCH_START):
+    V = np.atleast_2d(np.asarray(V, dtype=float))
+    I = np.atleast_2d(np.asarray(I, dtype=float))
+    ncurves, npoints = V.shape
+    nan = np.full(ncurves, np.nan)
+    if npoints < 3:
+        return nan, nan.copy(), nan.copy(), np.zeros(ncurves, dtype=int)
+    rows = np.arange(ncurves)
+    lnI  = np.log(np.maximum(np.abs(I), CURRENT_FLOOR))
+
+    # central differences, dlnI[:,j] belongs to V[:,j+1]
+    with np.errstate(divide='ignore', invalid='ignore'):
+        dlnI = (lnI[:,2:]-lnI[:,:-2])/(V[:,2:]-V[:,:-2])
+    dlnI[~np.isfinite(dlnI)] = -np.inf
+    peak = dlnI.argmax(axis=1)
+    ok   = np.isfinite(dlnI[rows,peak]) & (dlnI[rows,peak] > 0)
+
+    # vertex of the parabola through the peak and its neighbours
+    left  = np.maximum(peak-1, 0)
+    right = np.minimum(peak+1, npoints-3)
+    y0, y1, y2 = dlnI[rows,left], dlnI[rows,peak], dlnI[rows,right]
+    with np.errstate(invalid='ignore'):
+        curvature = y0-2*y1+y2
+        inner     = (left < peak) & (right > peak) & np.isfinite(y0) & np.isfinite(y2) & (curvature < 0)
+        shift     = np.where(inner, 0.5*(y0-y2)/np.where(inner, curvature, 1), 0.0)
+    vbd = V[rows,peak+1] + shift*0.5*(V[rows,peak+2]-V[rows,peak])
+    vbd[~ok] = np.nan
+
+    # ln(I) interpolated at vbd + overvoltage
+    target = vbd+overvoltage
+    with np.errstate(invalid='ignore'):
+        above = np.clip((V < target[:,None]).sum(axis=1), 1, npoints-1)
+        t     = (target-V[rows,above-1])/(V[rows,above]-V[rows,above-1])
+    idark = np.exp(lnI[rows,above-1] + t*(lnI[rows,above]-lnI[rows,above-1]))
+    with np.errstate(invalid='ignore'):
+        idark[~ok | (target > V[:,-1]) | (target < V[:,0])] = np.nan
+
+    # least squares dI/dV through the quench region
+    with np.errstate(invalid='ignore'):
+        mask = (V >= (vbd+quenchStart)[:,None]).astype(float)
+    count = mask.sum(axis=1)
+    with np.errstate(divide='ignore', invalid='ignore'):
+        vMean = (mask*V).sum(axis=1)/count
+        iMean = (mask*I).sum(axis=1)/count
+        dv    = V-vMean[:,None]
+        slope = (mask*dv*(I-iMean[:,None])).sum(axis=1)/(mask*dv*dv).sum(axis=1)
+    slope[~ok | (count < 2)] = np.nan
+
+    return vbd, idark, slope, ok.astype(int)
+
+
+# the feature rows of a list of entries, curves of the same length analyzed
+# together
+def entryFeatures(entries, overvoltage=OVERVOLTAGE, quenchStart=QUENCH_START):
+    groups = {}
+    rows   = []
+    for entry in entries:
+        row = {"entry_id": entry.id, "sipmid": entry.sipmid, "date": entry.date,
+               "temperature": entry.temperature, "overvoltage": overvoltage,
+               "vbd": None, "idark": None, "slope": None, "npoints": 0, "ok": 0}
+        rows.append(row)
+        if entry.varray is None or entry.iarray is None or entry.varray.size != entry.iarray.size:
+            continue
+        V, I = entry.varray, entry.iarray
+        if V.size > 1 and V[0] > V[-1]:
+            V, I = V[::-1], I[::-1]
+        row["npoints"] = int(V.size)
+        groups.setdefault(V.size, []).append((row, V, I))
+
+    for npoints, members in groups.items():
+        vbd, idark, slope, ok = ivFeatures(np.vstack([V for row, V, I in members]),
+                                           np.vstack([I for row, V, I in members]),
+                                           overvoltage, quenchStart)
+        for k, (row, V, I) in enumerate(members):
+            row["ok"] = int(ok[k])
+            for name, values in (("vbd", vbd), ("idark", idark), ("slope", slope)):
+                if np.isfinite(values[k]): row[name] = float(values[k])
+    return rows
+
+
+
+# one engine per worker process, opened on its first chunk
+workerEngines = {}
+
+# runs in a worker: read a chunk of entries and return their feature rows
+def analyzeChunk(url, entryIDs, overvoltage, quenchStart):
+    if url not in workerEngines:
+        workerEngines[url] = createDBEngine(url)
+    engine, Session = workerEngines[url]
+    session = Session()
+    try:
+        entries = session.query(Entry).filter(Entry.id.in_(entryIDs)).all()
+        return entryFeatures(entries, overvoltage, quenchStart)
+    finally:
+        session.close()
+
+
+# store the feature rows of a chunk in one transaction, replacing older ones
+def writeFeatures(session, rows):
+    try:
+        session.query(Feature).filter(Feature.entry_id.in_([row["entry_id"] for row in rows])) \
+               .delete(synchronize_session=False)
+        session.bulk_insert_mappings(Feature, rows)
+        session.commit()
+    except:
+        session.rollback()
+        raise
+
+
+# ids of the entries to analyze, in id order
+def pendingEntries(session, redo=0):
+    query = session.query(Entry.id)
+    if not redo:
+        query = query.outerjoin(Feature, Feature.entry_id == Entry.id).filter(Feature.id == None)
+    return [entryID for entryID, in query.order_by(Entry.id)]
+
+
+# analyze the pending entries of the database at url. workers=0 runs in this
+# process. Returns (analyzed, ok)
+def analyze(url, workers=None, chunkSize=500, overvoltage=OVERVOLTAGE, quenchStart=QUENCH_START,
+            redo=0, log=print):
+    engine, Session = createDBEngine(url)
+    session  = Session()
+    entryIDs = pendingEntries(session, redo)
+    chunks   = [entryIDs[k:k+chunkSize] for k in range(0, len(entryIDs), chunkSize)]
+    log("%i entries to analyze in %i chunks" % (len(entryIDs), len(chunks)))
+
+    analyzed = 0
+    good     = 0
+    tStart   = time.time()
+    def store(rows):
+        writeFeatures(session, rows)
+        return len(rows), sum(row["ok"] for row in rows)
+
+    try:
+        if workers == 0:
+            workerEngines[url] = (engine, Session)
+            for chunk in chunks:
+                n, k = store(analyzeChunk(url, chunk, overvoltage, quenchStart))
+                analyzed += n
+                good     += k
+        else:
+            from concurrent.futures import ProcessPoolExecutor
+            workers = workers or multiprocessing.cpu_count()
+            pool    = ProcessPoolExecutor(workers)
+            try:
+                # keep a few chunks in flight per worker, the results are
+                # written here as they come in
+                pending = []
+                for chunk in chunks:
+                    pending.append(pool.submit(analyzeChunk, url, chunk, overvoltage, quenchStart))
+                    if len(pending) >= 2*workers:
+                        n, k = store(pending.pop(0).result())
+                        analyzed += n
+                        good     += k
+                        log("%i analyzed (%.0f curves/s)" % (analyzed, analyzed/max(time.time()-tStart,1e-6)))
+                for future in pending:
+                    n, k = store(future.result())
+                    analyzed += n
+                    good     += k
+            finally:
+                pool.shutdown()
+    finally:
+        session.close()
+    log("%i curves analyzed in %.1f s, %i with a breakdown" % (analyzed, time.time()-tStart, good))
+    return analyzed, good
+
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="Compute breakdown voltage, dark current and slope of the stored IV curves")
+    parser.add_argument("--db", default=None, help="SQLAlchemy database URL (default: the configured database)")
+    parser.add_argument("--workers", type=int, default=None, help="worker processes, 0 to run in this process (default: one per CPU)")
+    parser.add_argument("--chunk", type=int, default=500, help="entries per chunk")
+    parser.add_argument("--overvoltage", type=float, default=OVERVOLTAGE, help="overvoltage of the dark current [V]")
+    parser.add_argument("--quench-start", type=float, default=QUENCH_START, help="start of the slope fit above breakdown [V]")
+    parser.add_argument("--redo", action="store_true", help="analyze every entry again, not only the new ones")
+    args = parser.parse_args(argv)
+
+    if args.db is None and not CONNECT_TO_REAL_DB:
+        parser.error("no database configured, give one with --db")
+    if args.db in ('sqlite://', 'sqlite:///:memory:'):
+        parser.error("an in-memory database can't be shared with the workers")
+
+    analyze(args.db, args.workers, args.chunk, args.overvoltage, args.quench_start, args.redo)
+    return 0
+
+
+
+if __name__ == "__main__":
+    sys.exit(main())
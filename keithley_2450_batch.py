@@ -0,0 +1,202 @@
+#
+# Headless batch sweeps: run a list of jobs on every available instrument and
+# store each measurement in the database, no GUI needed.
+#
+# The job file is a CSV file with a header line and the columns
+#
+#     sipmid, temperature, v0, v1, steps, dt, repetitions [, username, instrument]
+#     [, v_op, i_max, vbd_min, vbd_max]
+#
+# A job with any of the screening columns is a pass/fail sweep: it stops as
+# soon as the verdict is known (see screening_criteria) and the verdict is
+# stored with the entry.
+#
+# Every repetition is a separate job. A job with an instrument (device ID, the
+# serial number of the 2450) only runs on that unit, the others go to whichever
+# instrument is free. Finished jobs are appended to a journal (<jobfile>.done by
+# default) right after their entry is committed, so a crashed or interrupted run
+# carries on where it stopped when started again.
+#
+#     python keithley_2450_batch.py jobs.csv --db sqlite:///measurements.db
+#     python keithley_2450_batch.py jobs.csv --db sqlite:///measurements.db --fake 4
+#
+import os,sys,csv,time,threading
+import argparse
+
+from keithley_2450_core import data, keithley_2450_fake, instrument_pool, screening_criteria, dateString
+from keithley_2450_db import createDBEngine, writeEntry, CONNECT_TO_REAL_DB
+
+
+
+# one sweep of the job list. It carries the sweep settings under the same names
+# as the instruments, so it can be handed to writeEntry directly
+class batch_job():
+
+    def __init__(self, sipmID, temperature, parV0, parV1, parST, parDT, userName, deviceID=None, repetition=0,
+                 screening=None):
+        self.sipmID      = sipmID
+        self.temperature = temperature
+        self.parV0       = parV0
+        self.parV1       = parV1
+        self.parST       = parST
+        self.parDT       = parDT
+        self.userName    = userName
+        self.deviceID    = deviceID
+        self.repetition  = repetition
+        self.screening   = screening
+        self.key         = ""
+
+    def __repr__(self):
+        return "<batch_job(sipmID='%s', T=%g, V=%g..%g, steps=%i, dt=%g, rep=%i)>" % \
+               (self.sipmID, self.temperature, self.parV0, self.parV1, self.parST, self.parDT, self.repetition)
+
+
+
+# read the job file and expand the repetitions. Each job gets a key built from
+# its content, so the journal stays valid when lines are added or reordered
+def readJobs(filename, userName="batch"):
+    jobs = []
+    seen = {}
+    f = open(filename,'r')
+    try:
+        for line, row in enumerate(csv.DictReader(f), 2):
+            try:
+                row  = dict((k.strip().lower(), (v or "").strip()) for k,v in row.items() if k is not None)
+                nrep = int(row.get("repetitions") or 1)
+                limits = [float(row[name]) if row.get(name) else None for name in ("v_op","i_max","vbd_min","vbd_max")]
+                for rep in range(nrep):
+                    job = batch_job(row["sipmid"],
+                                    float(row["temperature"]),
+                                    float(row["v0"]),
+                                    float(row["v1"]),
+                                    int(row["steps"]),
+                                    float(row["dt"]),
+                                    row.get("username") or userName,
+                                    row.get("instrument") or None,
+                                    rep,
+                                    screening_criteria(*limits) if any(v is not None for v in limits) else None)
+                    key = "%s|%g|%g|%g|%i|%g|%s|%i" % (job.sipmID, job.temperature, job.parV0, job.parV1,
+                                                       job.parST, job.parDT, job.userName, rep)
+                    if job.screening is not None:
+                        key += "|screen:%s" % ",".join("%g" % v if v is not None else "" for v in limits)
+                    # identical lines are different jobs, count them apart
+                    seen[key] = seen.get(key,0)+1
+                    job.key   = "%s|%i" % (key, seen[key])
+                    jobs.append(job)
+            except (KeyError, ValueError) as e:
+                raise ValueError("%s: bad job on line %i (%s)" % (filename, line, e))
+    finally:
+        f.close()
+    return jobs
+
+
+
+class batch_scheduler():
+
+    def __init__(self, pool, Session, journal):
+        self.pool    = pool
+        self.Session = Session
+        self.journal = journal
+        self.lock    = threading.Lock()
+        self.done    = set()
+        if os.path.exists(journal):
+            f = open(journal,'r')
+            self.done = set(line.rstrip('\n') for line in f if line.strip())
+            f.close()
+
+    def pending(self, jobs):
+        return [job for job in jobs if job.key not in self.done]
+
+    # run the jobs not in the journal yet. Returns the pool results
+    def run(self, jobs):
+        return self.pool.run(self.pending(jobs), self.runJob)
+
+    # runs on the instrument thread: sweep, store, then journal the job
+    def runJob(self, inst, job):
+        inst.parV0 = job.parV0
+        inst.parV1 = job.parV1
+        inst.parST = job.parST
+        inst.parDT = job.parDT
+        inst.screening = job.screening
+
+        measurement             = data()
+        measurement.sipmID      = job.sipmID
+        measurement.userName    = job.userName
+        measurement.temperature = job.temperature
+        if inst.measureIV(measurement)!=1:
+            raise IOError("Sweep cancelled on "+inst.deviceID)
+        measurement.date    = dateString(micro=1)
+        measurement.hasData = 1
+
+        session = self.Session()
+        try:
+            writeEntry(session, measurement, job)
+        except:
+            session.rollback()
+            raise
+        finally:
+            session.close()
+
+        with self.lock:
+            f = open(self.journal,'a')
+            f.write(job.key+"\n")
+            f.flush()
+            os.fsync(f.fileno())
+            f.close()
+            self.done.add(job.key)
+        return measurement.date+(" "+measurement.verdict if measurement.verdict else "")
+
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="Run IV sweeps from a job file without the GUI")
+    parser.add_argument("jobfile", help="CSV job list")
+    parser.add_argument("--db", default=None, help="SQLAlchemy database URL (default: the configured database)")
+    parser.add_argument("--journal", default=None, help="file listing the finished jobs (default: <jobfile>.done)")
+    parser.add_argument("--user", default="batch", help="user name for jobs that do not give one")
+    parser.add_argument("--fake", type=int, default=0, help="use N fake instruments instead of real ones")
+    args = parser.parse_args(argv)
+
+    if args.db is None and not CONNECT_TO_REAL_DB:
+        parser.error("no database configured, give one with --db")
+
+    jobs = readJobs(args.jobfile, args.user)
+
+    if args.fake > 0:
+        pool = instrument_pool([keithley_2450_fake("fake%i" % i) for i in range(args.fake)])
+    else:
+        pool = instrument_pool()
+        pool.discover()
+    if pool.connect()==0:
+        print("No instrument available")
+        return 1
+    print("Instruments: "+", ".join(pool.deviceIDs()))
+
+    engine, Session = createDBEngine(args.db)
+    scheduler = batch_scheduler(pool, Session, args.journal or args.jobfile+".done")
+    todo = scheduler.pending(jobs)
+    print("%i jobs, %i already done, %i to run" % (len(jobs), len(jobs)-len(todo), len(todo)))
+
+    tStart = time.time()
+    failed = 0
+    try:
+        for deviceID, job, result in scheduler.run(todo):
+            if isinstance(result, Exception):
+                failed += 1
+                print("FAILED %s on %s: %s" % (job, deviceID, result))
+            else:
+                print("done   %s on %s at %s" % (job, deviceID, result))
+    except KeyboardInterrupt:
+        pool.stop()
+        print("Interrupted, finished jobs are kept in the journal")
+        return 1
+    finally:
+        pool.disconnect()
+
+    print("%i jobs run in %.1f s, %i failed" % (len(todo), time.time()-tStart, failed))
+    return 1 if failed else 0
+
+
+
+if __name__ == "__main__":
+    sys.exit(main())
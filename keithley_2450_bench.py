@@ -0,0 +1,275 @@
+#
+# Benchmarks of a full measurement cycle: module imports, the sweep (setup,
+# wait, transfer) against the simulated or the fake instrument, the text files,
+# the database (store, list, load) for growing table sizes and the plotting.
+# Every stage is timed for several point counts and written out as JSON, so
+# runs can be compared and regressions spotted before they reach the lab.
+#
+#     python keithley_2450_bench.py --output bench.json
+#     python keithley_2450_bench.py --quick
+#     python keithley_2450_bench.py --stages measure,plot --points 10,2000
+#
+import os,sys,time,json,shutil,tempfile,subprocess,platform,datetime
+import argparse
+import numpy as np
+
+from keithley_2450_core import data, keithley_2450, keithley_2450_fake, dateString
+
+
+MEASURE_MODES = ["ascii", "binary", "streaming", "tsp"]
+ALL_STAGES    = ["import", "measure", "file", "db", "plot"]
+
+
+
+# run fn repeat times and summarize the durations
+def timeCall(fn, repeat):
+    times = []
+    for i in range(repeat):
+        tStart = time.time()
+        fn()
+        times.append(time.time()-tStart)
+    return summarize(times)
+
+def summarize(times):
+    times = np.asarray(times, dtype=float)
+    return {"min": float(times.min()), "median": float(np.median(times)),
+            "mean": float(times.mean()), "repeat": int(times.size)}
+
+def record(results, stage, stats, **keys):
+    entry = {"stage": stage}
+    entry.update(keys)
+    entry.update(stats)
+    results.append(entry)
+    line = " ".join("%s=%s" % (k, keys[k]) for k in sorted(keys))
+    # progress on stderr, stdout only carries the JSON report
+    sys.stderr.write("%-28s %-40s median %9.3f ms\n" % (stage, line, 1e3*stats["median"]))
+
+def fakeCurve(npts):
+    d = data()
+    d.sipmID, d.userName, d.date = "bench", "bench", dateString(micro=1)
+    d.V = np.linspace(0, 30, npts)
+    d.I = 1e-9*np.exp(d.V/3.0)
+    d.hasData = 1
+    return d
+
+def sweepSettings(npts, dt=0.001):
+    inst = keithley_2450_fake()
+    inst.parV0, inst.parV1, inst.parST, inst.parDT = 20, 30, npts, dt
+    return inst
+
+
+
+# cold import of each module in a fresh interpreter
+def benchImports(results, repeat):
+    for module in ["keithley_2450_core", "keithley_2450_db", "keithley_2450_plot"]:
+        code  = "import sys,time; sys.path.insert(0,%r); t=time.time(); import %s; print(time.time()-t)" % \
+                (os.path.dirname(os.path.abspath(__file__)), module)
+        times = []
+        for i in range(repeat):
+            out = subprocess.check_output([sys.executable, "-c", code])
+            times.append(float(out.decode().strip().splitlines()[-1]))
+        record(results, "import", summarize(times), module=module)
+
+
+# the sweep itself, split in the setup, wait and transfer stages the driver reports
+def benchMeasure(results, points, repeat, args):
+    for npts in points:
+        if args.instrument == "fake":
+            insts = {"fake": keithley_2450_fake()}
+        else:
+            from keithley_2450_sim import sim_resource_manager
+            # one simulated unit per mode: each driver keeps track of the
+            # settings of its own instrument
+            insts = {}
+            for mode in MEASURE_MODES:
+                rm   = sim_resource_manager(1, lineFreq=1.0/args.reading_time, latency=args.latency,
+                                            bandwidth=args.bandwidth, language="TSP" if mode == "tsp" else "SCPI")
+                inst = keithley_2450(rm.list_resources()[0], rm)
+                inst.useTSP    = 1 if mode == "tsp" else 0
+                inst.useBinary = 0 if mode == "ascii" else 1
+                inst.streaming = 1 if mode == "streaming" else 0
+                inst.lineFreq  = 1.0/args.reading_time   # the wait is planned from the reading time
+                inst.connect()
+                insts[mode] = inst
+
+        for mode, inst in sorted(insts.items()):
+            inst.parV0, inst.parV1, inst.parST, inst.parDT = 20, 30, npts, args.dt
+            stages = {}
+            for i in range(repeat):
+                tStart = time.time()
+                if inst.measureIV(data()) != 1:
+                    raise RuntimeError("sweep failed: "+inst.logMessage)
+                stages.setdefault("total", []).append(time.time()-tStart)
+                for stage, t in inst.timing.items():
+                    stages.setdefault(stage, []).append(t)
+            for stage in sorted(stages):
+                record(results, "measureIV."+stage, summarize(stages[stage]), points=npts, mode=mode)
+
+
+# data.write / data.read of the text format
+def benchFiles(results, points, repeat, tmpdir):
+    for npts in points:
+        d, inst = fakeCurve(npts), sweepSettings(npts)
+        filename = os.path.join(tmpdir, "bench_%i.txt" % npts)
+        record(results, "data.write", timeCall(lambda: d.write(filename, inst), repeat), points=npts)
+        record(results, "data.read", timeCall(lambda: data().read(filename, inst), repeat), points=npts)
+
+
+# store, list and load against a SQLite file holding dbSizes entries of npts points
+def benchDB(results, dbSizes, npts, repeat, tmpdir):
+    from keithley_2450_db import Entry, createDBEngine, writeEntry, writeEntries, listEntries, loadEntry, \
+                                  entry_cache, loadEntryCached
+
+    engine, Session = createDBEngine("sqlite:///"+os.path.join(tmpdir, "bench.db"))
+    inst  = sweepSettings(npts)
+    curve = fakeCurve(npts)
+    count = 0
+    for size in sorted(dbSizes):
+        # fill the table up to the next size in large batches
+        session = Session()
+        while count < size:
+            batch = min(5000, size-count)
+            session.add_all([Entry(username="bench", sipmid="D%06i" % (count+i), temperature=20.0,
+                                   date="2000-1-1 0:0:%i" % (count+i), v0=20.0, v1=30.0, steps=npts,
+                                   deltat=0.001, varray=curve.V, iarray=curve.I) for i in range(batch)])
+            session.commit()
+            count += batch
+        session.close()
+
+        def store():
+            session = Session()
+            writeEntry(session, fakeCurve(npts), inst)
+            session.close()
+        def storeBatch():
+            session = Session()
+            writeEntries(session, [(fakeCurve(npts), inst) for i in range(100)])
+            session.close()
+        def listAll():
+            session = Session()
+            for entry in listEntries(session):
+                entry.date+" | "+entry.sipmid+" | "+entry.username
+            session.close()
+        def firstPage():
+            session = Session()
+            for entry in listEntries(session, limit=200):
+                entry.date+" | "+entry.sipmid+" | "+entry.username
+            session.close()
+        def load():
+            session = Session()
+            entry = loadEntry(session, "D%06i" % (size//2), "2000-1-1 0:0:%i" % (size//2))
+            entry.varray, entry.iarray
+            session.close()
+        cache = entry_cache()
+        def loadCached():
+            session = Session()
+            loadEntryCached(session, cache, "D%06i" % (size//2), "2000-1-1 0:0:%i" % (size//2))
+            session.close()
+        loadCached()
+
+        record(results, "writeEntry", timeCall(store, repeat), entries=size, points=npts)
+        record(results, "writeEntries.100", timeCall(storeBatch, repeat), entries=size, points=npts)
+        record(results, "GenerateImportList", timeCall(listAll, repeat), entries=size, points=npts)
+        record(results, "GenerateImportList.page", timeCall(firstPage, repeat), entries=size, points=npts)
+        record(results, "ImportSingleEntry", timeCall(load, repeat), entries=size, points=npts)
+        record(results, "ImportSingleEntry.cached", timeCall(loadCached, repeat), entries=size, points=npts)
+        count += 101*repeat
+    engine.dispose()
+
+
+# RefreshPlot, drawn on an Agg canvas of the GUI figure size: the full redraw
+# of plotIV, the renderer for a new curve, for a refresh of the same curve and
+# for the growing curve of a live sweep
+def benchPlot(results, points, repeat):
+    from matplotlib.figure import Figure
+    from matplotlib.backends.backend_agg import FigureCanvasAgg
+    from keithley_2450_plot import plotIV, iv_renderer
+
+    figure  = Figure(figsize=(5,5), dpi=100)
+    canvas  = FigureCanvasAgg(figure)
+    plotter = figure.add_subplot(111)
+    for npts in points:
+        d = fakeCurve(npts)
+        def refresh():
+            plotIV(figure, plotter, d, npts)
+            canvas.draw()
+        refresh()   # the first call also imports scipy
+        record(results, "RefreshPlot.full", timeCall(refresh, repeat), points=npts)
+
+    figure   = Figure(figsize=(5,5), dpi=100)
+    canvas   = FigureCanvasAgg(figure)
+    renderer = iv_renderer(figure, figure.add_subplot(111), canvas)
+    for npts in points:
+        curves = [fakeCurve(npts) for i in range(repeat)]
+        def newCurve():
+            renderer.refresh(curves.pop(), npts)
+        record(results, "RefreshPlot.new", timeCall(newCurve, repeat), points=npts)
+        d = fakeCurve(npts)
+        renderer.refresh(d, npts)
+        record(results, "RefreshPlot", timeCall(lambda: renderer.refresh(d, npts), repeat), points=npts)
+
+        # a sweep delivered in 20 partial curves, timed per refresh
+        live  = data()
+        live.sipmID = d.sipmID
+        steps = np.linspace(0, npts, 21).astype(int)[1:]
+        times = []
+        for k in steps:
+            live.V, live.I = d.V[:k], d.I[:k]
+            tStart = time.time()
+            renderer.refresh(live, npts, live=1, xRange=(d.V[0], d.V[-1]))
+            times.append(time.time()-tStart)
+        record(results, "RefreshPlot.live", summarize(times), points=npts)
+
+
+
+def intList(text):
+    return [int(v) for v in text.split(",") if v.strip()]
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="Time every stage of a measurement cycle")
+    parser.add_argument("--output", default=None, help="JSON file for the results (default: stdout)")
+    parser.add_argument("--stages", default=",".join(ALL_STAGES), help="comma separated subset of "+",".join(ALL_STAGES))
+    parser.add_argument("--points", type=intList, default=[10,100,500,1000,2000], help="sweep sizes")
+    parser.add_argument("--db-sizes", type=intList, default=[100,1000,10000,100000], help="table sizes")
+    parser.add_argument("--db-points", type=int, default=100, help="points per entry in the database benchmark")
+    parser.add_argument("--repeat", type=int, default=3)
+    parser.add_argument("--instrument", choices=["sim","fake"], default="sim")
+    parser.add_argument("--dt", type=float, default=0.001, help="sweep delay per point [s]")
+    parser.add_argument("--reading-time", type=float, default=0.0002, help="simulated integration time [s]")
+    parser.add_argument("--latency", type=float, default=0.5e-3, help="simulated bus latency [s]")
+    parser.add_argument("--bandwidth", type=float, default=1e6, help="simulated bus bandwidth [bytes/s]")
+    parser.add_argument("--quick", action="store_true", help="small point counts and tables only")
+    args = parser.parse_args(argv)
+
+    if args.quick:
+        args.points   = [p for p in args.points if p <= 100]
+        args.db_sizes = [s for s in args.db_sizes if s <= 1000]
+        args.repeat   = 1
+    stages = [s.strip() for s in args.stages.split(",")]
+
+    results = []
+    tmpdir  = tempfile.mkdtemp(prefix="k2450bench")
+    try:
+        if "import" in stages:  benchImports(results, args.repeat)
+        if "measure" in stages: benchMeasure(results, args.points, args.repeat, args)
+        if "file" in stages:    benchFiles(results, args.points, args.repeat, tmpdir)
+        if "db" in stages:      benchDB(results, args.db_sizes, args.db_points, args.repeat, tmpdir)
+        if "plot" in stages:    benchPlot(results, args.points, args.repeat)
+    finally:
+        shutil.rmtree(tmpdir, ignore_errors=True)
+
+    report = {"meta": {"date": datetime.datetime.now().isoformat(), "python": platform.python_version(),
+                       "numpy": np.__version__, "platform": platform.platform(), "args": vars(args)},
+              "results": results}
+    text = json.dumps(report, indent=1, sort_keys=True)
+    if args.output:
+        f = open(args.output, 'w')
+        f.write(text+"\n")
+        f.close()
+    else:
+        print(text)
+    return 0
+
+
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -0,0 +1,1240 @@
+#
+# Instrument side of the IV measurement: the data container, the Keithley 2450
+# drivers, the threaded measurement task and the instrument pool. Nothing here
+# imports the GUI, the plotting or the database, and VISA is only loaded when a
+# real instrument is used, so scripts can import this module quickly.
+#
+import os,time,datetime,json,zipfile,itertools
+import threading
+from concurrent import futures
+import numpy as np
+
+from sys import version_info
+if version_info.major == 2:
+    # Python 2
+    import Queue as queue
+elif version_info.major == 3:
+    # Python 3
+    import queue
+
+
+KEITHLEY_2450_RESOURCES = '?*::0x05E6::0x2450::?*::INSTR'
+
+NPZ_MAGIC = b'PK\x03\x04'   # .npz files are zip archives
+
+ADAPTIVE_COARSE = 0.25   # share of the points of an adaptive sweep in its coarse pass
+ADAPTIVE_FLOOR  = 0.05   # minimum point density of the fine pass, relative to its peak
+LIST_CHUNK      = 100    # voltages per SOUR:LIST:VOLT[:APP] command
+
+MAX_MESSAGE = 4000       # characters per message written by configure
+
+LINE_FREQUENCY = 50      # mains frequency, sets the integration time of 1 NPLC [Hz]
+
+MONITOR_BLOCK        = 10000     # readings per trigger model run of a monitoring run
+MONITOR_CHUNK_POINTS = 1000000   # samples per chunk file of a monitoring run (16 MB)
+MONITOR_HEADER       = "monitor.json"
+MONITOR_RECORD       = np.dtype([("t", "<f8"), ("i", "<f8")])
+
+
+
+# voltages for the fine pass of an adaptive sweep: n points spread with a
+# density following the bend of ln(I) between the coarse points (the change
+# of d ln(I)/dV), so they gather at the breakdown knee. floor keeps some
+# points everywhere, relative to the densest interval
+def adaptivePoints(V, I, n, floor=ADAPTIVE_FLOOR):
+    order = np.argsort(V, kind='mergesort')
+    V     = np.asarray(V, dtype=float)[order]
+    lnI   = np.log(np.maximum(np.abs(np.asarray(I, dtype=float)[order]), 1e-15))
+    if n <= 0 or V.size < 2: return np.zeros(0)
+    weight = np.zeros(V.size-1)
+    if V.size > 2:
+        with np.errstate(divide='ignore', invalid='ignore'):
+            slope = np.diff(lnI)/np.diff(V)
+        bend = np.abs(np.diff(slope))
+        bend[~np.isfinite(bend)] = 0
+        # an interval gets the larger bend of its two ends
+        weight[:-1] = bend
+        weight[1:]  = np.maximum(weight[1:], bend)
+    weight += floor*weight.max() if weight.max() > 0 else 1.0
+    weight *= np.diff(V) > 0   # nothing to place between repeated voltages
+    # invert the cumulative weight, uniform inside every interval
+    cumulative = np.concatenate(([0], np.cumsum(weight)))
+    return np.interp((np.arange(n)+0.5)/n*cumulative[-1], cumulative, V)
+
+
+# pass/fail limits of a screening sweep, None for a limit that isn't checked:
+# the dark current at vOp must stay under iMax and the breakdown voltage (the
+# peak of d ln(I)/dV) must lie in vbdMin..vbdMax. Hitting the current limit
+# fails. check() looks at the readings of a rising sweep so far and returns
+# the verdict as soon as it is decided
+class screening_criteria():
+
+    def __init__(self, vOp=None, iMax=None, vbdMin=None, vbdMax=None, iLimit=1.0):
+        self.vOp       = vOp
+        self.iMax      = iMax
+        self.vbdMin    = vbdMin
+        self.vbdMax    = vbdMax
+        self.iLimit    = iLimit    # SOUR:VOLT:ILIM of the sweep [A]
+        self.kneeSlope = 2.0       # d ln(I)/dV a breakdown peak must reach [1/V]
+        self.kneeWidth = 1.0       # how far past vbdMax a breakdown is waited for [V]
+
+    # "" while undecided, "PASS" or "FAIL <reason>". With final=1 the sweep is
+    # over and an undecided result fails
+    def check(self, V, I, final=0):
+        V = np.asarray(V, dtype=float)
+        I = np.abs(np.asarray(I, dtype=float))
+        if V.size == 0:
+            return "FAIL no readings" if final else ""
+        if I.max() >= 0.99*self.iLimit:
+            return "FAIL compliance at %.2f V" % V[np.argmax(I >= 0.99*self.iLimit)]
+
+        darkOK = self.vOp is None or self.iMax is None
+        if not darkOK and V[-1] >= self.vOp:
+            idark = np.interp(self.vOp, V, I)
+            if idark > self.iMax:
+                return "FAIL dark current %.3g A at %.2f V" % (idark, self.vOp)
+            darkOK = 1
+
+        vbdOK = self.vbdMin is None and self.vbdMax is None
+        if not vbdOK:
+            vbd = self.breakdown(V, I)
+            if vbd is None:
+                if self.vbdMax is not None and V[-1] > self.vbdMax+self.kneeWidth:
+                    return "FAIL no breakdown below %.2f V" % self.vbdMax
+            elif self.vbdMin is not None and vbd < self.vbdMin:
+                return "FAIL breakdown at %.2f V" % vbd
+            elif self.vbdMax is not None and vbd > self.vbdMax:
+                return "FAIL breakdown at %.2f V" % vbd
+            else:
+                vbdOK = 1
+
+        if darkOK and vbdOK: return "PASS"
+        return "FAIL undecided at %.2f V" % V[-1] if final else ""
+
+    # V at the peak of d ln(I)/dV once the readings are past it, None before
+    def breakdown(self, V, I):
+        if V.size < 4: return None
+        lnI = np.log(np.maximum(I, 1e-15))
+        with np.errstate(divide='ignore', invalid='ignore'):
+            slope = (lnI[2:]-lnI[:-2])/(V[2:]-V[:-2])
+        slope[~np.isfinite(slope)] = 0
+        peak = slope.argmax()
+        if slope[peak] < self.kneeSlope or slope[peak+1:].size == 0 or slope[peak+1:].min() > 0.5*slope[peak]:
+            return None
+        return V[peak+1]
+
+
+# running mean and variance of repeated sweeps, point by point (Welford's
+# update), so any number of sweeps is averaged in the memory of one
+class sweep_statistics():
+
+    def __init__(self):
+        self.count = 0
+        self.mean  = None
+        self.m2    = None    # sum of the squared deviations from the mean
+
+    def add(self, values):
+        values = np.asarray(values, dtype=float)
+        if self.count == 0:
+            self.mean = np.zeros(values.size)
+            self.m2   = np.zeros(values.size)
+        elif values.size != self.mean.size:
+            raise ValueError("a sweep of %i points can't be averaged with sweeps of %i" % (values.size, self.mean.size))
+        self.count += 1
+        delta      = values-self.mean
+        self.mean += delta/self.count
+        self.m2   += delta*(values-self.mean)
+
+    # sample variance of every point, 0 after a single sweep
+    def variance(self):
+        if self.count < 2: return np.zeros_like(self.mean)
+        return self.m2/(self.count-1)
+
+    # standard error of the mean of every point
+    def error(self):
+        return np.sqrt(self.variance()/self.count)
+
+
+# TSP sweep loaded into a 2450 in TSP mode: one call runs the whole sweep and
+# prints the source values and readings (and the timestamps when withTimes is
+# 1) as one little-endian REAL64 block
+TSP_SCRIPT_NAME = "k2450script"
+TSP_SWEEP_SCRIPT = [
+    "function k2450sweep(v0, v1, n, dt, withTimes, nplc, filterCount)",
+    "  smu.source.func = smu.FUNC_DC_VOLTAGE",
+    "  smu.measure.func = smu.FUNC_DC_CURRENT",
+    "  smu.measure.autorange = smu.ON",
+    "  smu.measure.nplc = nplc",
+    "  if filterCount > 1 then",
+    "    smu.measure.filter.type = smu.FILTER_REPEAT_AVG",
+    "    smu.measure.filter.count = filterCount",
+    "    smu.measure.filter.enable = smu.ON",
+    "  else",
+    "    smu.measure.filter.enable = smu.OFF",
+    "  end",
+    "  smu.source.ilimit.level = 1",
+    "  smu.source.sweeplinear(\"k2450\", v0, v1, n, dt)",
+    "  defbuffer1.clear()",
+    "  trigger.model.initiate()",
+    "  waitcomplete()",
+    "  smu.source.output = smu.OFF",
+    "  format.data = format.REAL64",
+    "  format.byteorder = format.LITTLEENDIAN",
+    "  if withTimes == 1 then",
+    "    printbuffer(1, defbuffer1.n, defbuffer1.sourcevalues, defbuffer1.readings, defbuffer1.relativetimestamps)",
+    "  else",
+    "    printbuffer(1, defbuffer1.n, defbuffer1.sourcevalues, defbuffer1.readings)",
+    "  end",
+    "end"]
+
+
+
+# the date format used for the measurements, with optional microseconds for
+# measurements taken in quick succession
+def dateString(now=None, micro=0):
+    if now is None: now = datetime.datetime.now()
+    date = "%s-%s-%s %s:%s:%s" % (now.year,now.month,now.day,now.hour,now.minute,now.second)
+    if micro: date += ".%06i" % now.microsecond
+    return date
+
+
+
+class data():
+    
+    def __init__(self):
+        self.V           = np.array([0])
+        self.I           = np.array([0])
+        self.T           = np.array([0])
+        self.temperature = 20
+        self.date        = ""
+        self.sipmID    = ""
+        self.userName    = ""
+        self.hasData     = 0
+        self.verdict     = ""     # outcome of a screening sweep, "" if not screened
+        self.Ierr        = None   # standard error of I over repeated sweeps, None for a single sweep
+        self.sweeps      = 1      # number of sweeps averaged into I, None if unknown
+        
+    # read a measurement saved by write(), the format is detected from the
+    # content. The sweep settings go into inst. Returns 1, raises IOError or
+    # ValueError with the file name when the file can't be read
+    def read(self, filename, inst):
+        f = open(filename,'rb')
+        try:
+            self.readStream(f, inst, filename)
+        finally:
+            f.close()
+        return 1
+
+    # the same from an open binary file object, e.g. an io.BytesIO. name is
+    # only used in the error message
+    def readStream(self, f, inst, name):
+        try:
+            binary = (f.read(4) == NPZ_MAGIC)
+            f.seek(0)
+            if binary:
+                self.readBinary(f, inst)
+            else:
+                self.readText(f, inst)
+        except (KeyError, ValueError, IndexError, EOFError, zipfile.BadZipfile) as e:
+            # BadZipfile (BadZipFile in Python 3) and EOFError: a damaged .npz
+            raise ValueError("%s: not a valid measurement file (%s)" % (name, e))
+        return 1
+
+
+    # write the measurement, as a binary .npz container when the name ends in
+    # .npz, in the text format otherwise. Returns 1, raises IOError on failure
+    def write(self, filename, inst):
+        f = open(filename,'wb')
+        try:
+            if filename.lower().endswith(".npz"):
+                self.writeBinary(f, inst)
+            else:
+                self.writeText(f, inst)
+        finally:
+            f.close()
+        return 1
+
+
+    # text format: 9 header lines (device ID, user, date, temperature, V0, V1,
+    # steps, dT, number of points) followed by one "V I" line per point, or
+    # "V I Ierr" for the mean of repeated sweeps
+    def readText(self, f, inst):
+        header = [f.readline().decode().rstrip('\r\n') for i in range(9)]
+        self.sipmID      = header[0]
+        self.userName    = header[1]
+        self.date        = header[2]
+        self.temperature = float(header[3])
+        inst.parV0       = float(header[4])
+        inst.parV1       = float(header[5])
+        inst.parST       = int(header[6])
+        inst.parDT       = float(header[7])
+        #
+        npts   = int(header[8])
+        values = np.fromstring(f.read().decode(), sep=' ')
+        if values.size not in (2*npts, 3*npts):
+            raise ValueError("expected %i points, found %i values" % (npts, values.size))
+        values = values.reshape(npts,-1)
+        self.V = values[:,0].copy()
+        self.I = values[:,1].copy()
+        self.Ierr = values[:,2].copy() if values.shape[1] == 3 else None
+        self.sweeps = 1 if self.Ierr is None else None   # averaged, the count isn't in the file
+
+    def writeText(self, f, inst):
+        header = [self.sipmID, self.userName, self.date, str(self.temperature),
+                  str(inst.parV0), str(inst.parV1), str(inst.parST), str(inst.parDT), str(self.V.size)]
+        # one formatting call for all points, %r keeps the shortest exact repr
+        columns = (self.V,self.I) if self.Ierr is None else (self.V,self.I,self.Ierr)
+        values  = np.column_stack(columns).ravel().tolist()
+        body    = (("%r "*(len(columns)-1) + "%r\n") * self.V.size) % tuple(values)
+        f.write(("\n".join(header)+"\n"+body).encode())
+
+
+    # binary format: an uncompressed .npz holding the V, I and T arrays (and
+    # Ierr for repeated sweeps) and the header fields as a JSON string
+    def readBinary(self, f, inst):
+        archive = np.load(f, allow_pickle=False)
+        header  = json.loads(str(archive["header"]))
+        self.sipmID      = header["sipmID"]
+        self.userName    = header["userName"]
+        self.date        = header["date"]
+        self.temperature = float(header["temperature"])
+        inst.parV0       = float(header["parV0"])
+        inst.parV1       = float(header["parV1"])
+        inst.parST       = int(header["parST"])
+        inst.parDT       = float(header["parDT"])
+        self.V = archive["V"]
+        self.I = archive["I"]
+        self.T = archive["T"] if "T" in archive.files else np.zeros(self.V.size)
+        self.Ierr   = archive["Ierr"] if "Ierr" in archive.files else None
+        sweeps      = header.get("sweeps", 1)
+        self.sweeps = None if sweeps is None else int(sweeps)
+        if self.I.size != self.V.size:
+            raise ValueError("%i voltages for %i currents" % (self.V.size, self.I.size))
+
+    def writeBinary(self, f, inst):
+        header = {"sipmID": self.sipmID, "userName": self.userName, "date": self.date,
+                  "temperature": float(self.temperature), "parV0": float(inst.parV0),
+                  "parV1": float(inst.parV1), "parST": int(inst.parST), "parDT": float(inst.parDT),
+                  "sweeps": None if self.sweeps is None else int(self.sweeps)}
+        arrays = {"V": np.asarray(self.V,dtype=float), "I": np.asarray(self.I,dtype=float),
+                  "T": np.asarray(self.T,dtype=float)}
+        if self.Ierr is not None: arrays["Ierr"] = np.asarray(self.Ierr,dtype=float)
+        np.savez(f, header=np.array(json.dumps(header)), **arrays)
+
+
+
+# the samples of a monitoring run on disk: a directory holding the run header
+# (MONITOR_HEADER) and numbered chunk files of raw (t, I) records, t in
+# seconds from the start of the run. Samples are only ever appended and a
+# chunk is closed once it holds chunkPoints of them, so a crash loses no more
+# than the last unflushed write and a running log can be read at any time
+class monitor_log():
+
+    def __init__(self, directory, header=None, chunkPoints=MONITOR_CHUNK_POINTS):
+        if not os.path.isdir(directory): os.makedirs(directory)
+        if os.path.exists(os.path.join(directory, MONITOR_HEADER)):
+            raise IOError("%s already holds a monitoring run" % directory)
+        self.directory   = directory
+        self.chunkPoints = chunkPoints
+        self.chunk       = 0
+        self.inChunk     = 0
+        self.count       = 0
+        self.file        = None
+        header = dict(header or {})
+        header["record"] = [[name, MONITOR_RECORD[name].str] for name in MONITOR_RECORD.names]
+        f = open(os.path.join(directory, MONITOR_HEADER), 'w')
+        json.dump(header, f, indent=1)
+        f.close()
+
+    def append(self, T, I):
+        records = np.empty(np.size(T), dtype=MONITOR_RECORD)
+        records["t"] = T
+        records["i"] = I
+        done = 0
+        while done < records.size:
+            if self.file is None:
+                self.file = open(monitorChunk(self.directory, self.chunk), 'ab')
+            n = min(records.size-done, self.chunkPoints-self.inChunk)
+            self.file.write(records[done:done+n].tobytes())
+            done         += n
+            self.inChunk += n
+            if self.inChunk == self.chunkPoints:
+                self.file.close()
+                self.file    = None
+                self.chunk  += 1
+                self.inChunk = 0
+        if self.file is not None: self.file.flush()
+        self.count += records.size
+
+    def close(self):
+        if self.file is not None:
+            self.file.close()
+            self.file = None
+
+
+def monitorChunk(directory, chunk):
+    return os.path.join(directory, "chunk-%05i.bin" % chunk)
+
+# read a monitoring run written by monitor_log, also while it is running.
+# Returns (header, T, I)
+def readMonitor(directory):
+    f = open(os.path.join(directory, MONITOR_HEADER), 'r')
+    try:
+        header = json.load(f)
+    finally:
+        f.close()
+    chunks = []
+    chunk  = 0
+    while os.path.exists(monitorChunk(directory, chunk)):
+        f = open(monitorChunk(directory, chunk), 'rb')
+        raw = f.read()
+        f.close()
+        # a record cut by a crash (or being written) is dropped
+        chunks.append(np.frombuffer(raw[:len(raw)-len(raw)%MONITOR_RECORD.itemsize], dtype=MONITOR_RECORD))
+        chunk += 1
+    records = np.concatenate(chunks) if chunks else np.zeros(0, dtype=MONITOR_RECORD)
+    return header, records["t"].copy(), records["i"].copy()
+
+
+
+# run a measureIV call on a worker thread so the GUI keeps running.
+# The instrument posts ("progress", fraction) and ("partial", (V,I)) messages
+# while sweeping, the task adds ("done", data), ("cancelled", None) or
+# ("error", message) when it stops. The GUI drains self.queue from the Tk loop.
+# action replaces measureIV, it is called as action(data, task) and returns
+# 1 when done, 0 if cancelled, e.g. a monitoring run posting (T,I) partials
+class measurement_task():
+
+    def __init__(self, inst, data, action=None):
+        self.inst      = inst
+        self.data      = data
+        self.action    = action if action is not None else inst.measureIV
+        self.queue     = queue.Queue()
+        self.status    = 0
+        self.cancelled = threading.Event()
+        self.finished  = threading.Event()
+        self.thread    = threading.Thread(target=self.run)
+        self.thread.daemon = True
+
+    def start(self):
+        self.thread.start()
+        return self
+
+    def run(self):
+        try:
+            self.status = self.action(self.data, self)
+            if self.status==1:
+                self.queue.put(("done", self.data))
+            else:
+                self.queue.put(("cancelled", None))
+        except Exception as e:
+            # never leave the output on after a failed sweep
+            try:
+                self.inst.abort()
+            except:
+                pass
+            self.queue.put(("error", str(e)))
+        finally:
+            self.finished.set()
+
+    def cancel(self):
+        self.cancelled.set()
+
+    def isCancelled(self):
+        return self.cancelled.is_set()
+
+    def isDone(self):
+        return self.finished.is_set()
+
+    def wait(self, timeout=None):
+        self.finished.wait(timeout)
+        return self.status
+
+    def postProgress(self, fraction):
+        self.queue.put(("progress", min(max(fraction,0.0),1.0)))
+
+    def postPartial(self, V, I):
+        self.queue.put(("partial", (np.array(V), np.array(I))))
+
+
+# the task as seen by sweep index of count repeated sweeps: the progress is
+# scaled onto the whole run and the partial curves of the single sweeps are
+# dropped, averageSweeps posts the running mean instead
+class repeat_progress():
+
+    def __init__(self, task, index, count):
+        self.task  = task
+        self.index = index
+        self.count = count
+
+    def isCancelled(self):
+        return self.task.isCancelled()
+
+    def postProgress(self, fraction):
+        self.task.postProgress((self.index+min(max(fraction,0.0),1.0))/float(self.count))
+
+    def postPartial(self, V, I):
+        pass
+
+
+# run inst.repeats sweeps with sweepOnce(data,task) and keep the mean current
+# of every point in data.I, its standard error in data.Ierr. Only the running
+# statistics are kept between sweeps. Returns 1, 0 if cancelled
+def averageSweeps(inst, data, task, sweepOnce):
+    stats  = sweep_statistics()
+    timing = {}
+    for k in range(inst.repeats):
+        single = data.__class__()
+        if sweepOnce(single, repeat_progress(task,k,inst.repeats) if task is not None else None)==0:
+            return 0
+        stats.add(single.I)
+        for stage, t in inst.timing.items(): timing[stage] = timing.get(stage,0)+t
+        if task is not None:
+            task.postPartial(single.V, stats.mean)
+    data.V, data.T = single.V, single.T
+    data.I      = stats.mean
+    data.Ierr   = stats.error()
+    data.sweeps = stats.count
+    inst.timing     = timing
+    inst.logMessage = "Mean of %i sweeps of %i points" % (stats.count, data.V.size)
+    return 1
+
+
+
+class keithley_2450_fake():
+
+    serial = itertools.count(1)   # numbers the default device IDs, a pool needs distinct ones
+
+    def __init__(self, deviceID=None):
+        self.name = "Fake Keithley 2450"
+        self.deviceID   = deviceID if deviceID is not None else "fake%i" % next(keithley_2450_fake.serial)
+        self.logMessage = ''
+        self.parV0      = 0
+        self.parV1      = 2
+        self.parST      = 10
+        self.parDT      = 0.01
+        self.Vmax       = 10
+        self.STmax      = 2000
+        self.DTmin      = 0.01
+        self.DTmax      = 1
+        self.streaming  = 0
+        self.screening  = None   # screening_criteria, judged on the full fake sweep
+        self.repeats    = 1
+        self.nplc       = 1
+        self.filterCount = 1
+        self.lineFreq   = LINE_FREQUENCY
+        self.monitorBlock = MONITOR_BLOCK
+        self.timing     = {}
+        
+
+    def printDevices(self):
+        print("I see the fake device");
+
+    def connect(self):
+        self.logMessage = "I am connected to the fake keithley"
+        return 1
+        
+    def disconnect(self):
+        pass
+
+    def checkConnection(self):
+        return 1
+
+    def abort(self):
+        pass
+
+    def pointTime(self):
+        return self.parDT + max(self.filterCount,1)*self.nplc/float(self.lineFreq)
+
+    def measureIV(self,data,task=None):
+        data.Ierr, data.sweeps = None, 1
+        if self.repeats > 1 and self.screening is None:
+            return averageSweeps(self,data,task,self.measureIVOnce)
+        return self.measureIVOnce(data,task)
+
+    def measureIVOnce(self,data,task=None):
+        tStart = time.time()
+        V = np.linspace(self.parV0,self.parV1,self.parST,1)
+        I = np.random.uniform(0, 1, size=self.parST)
+
+        # emulate the sweep timing so progress and partial results can be followed
+        chunk = max(1,self.parST//20)
+        for i in range(0,self.parST,chunk):
+            time.sleep(min(chunk,self.parST-i)*self.pointTime())
+            if task is not None:
+                if task.isCancelled():
+                    self.abort()
+                    return 0
+                task.postProgress(float(i+chunk)/self.parST)
+                if self.streaming:
+                    task.postPartial(V[:i+chunk],I[:i+chunk])
+
+        data.V = V
+        data.I = I
+        if self.screening is not None:
+            data.verdict = self.screening.check(V,I,1)
+        self.logMessage = "Fake sweep of %i points done" % self.parST
+        self.timing     = {"setup": 0, "wait": time.time()-tStart, "transfer": 0}
+        return 1
+
+    def monitorI(self,voltage,task=None,log=None,duration=None):
+        tStart = time.time()
+        nTotal = 0
+        while duration is None or time.time()-tStart < duration:
+            time.sleep(0.1)
+            if task is not None and task.isCancelled():
+                return 0
+            # the readings due since the last chunk
+            elapsed = time.time()-tStart
+            if duration is not None: elapsed = min(elapsed,duration)
+            T = np.arange(nTotal, int(elapsed/self.pointTime()))*self.pointTime()
+            I = 1e-6*(1+0.01*T/3600.0) + np.random.uniform(0, 1e-8, size=T.size)
+            nTotal += T.size
+            if log is not None: log.append(T,I)
+            if task is not None:
+                if duration: task.postProgress(elapsed/duration)
+                task.postPartial(T,I)
+        self.logMessage = "Fake monitoring at %g V: %i readings" % (voltage,nTotal)
+        return 1
+
+
+
+
+
+class keithley_2450():
+
+    #USBname and rm let several instruments share one resource manager
+    def __init__(self, USBname='USB0::0x05E6::0x2450::04086751::INSTR', rm=None):
+        if rm is None:
+            import visa
+            rm = visa.ResourceManager()
+        self.rm         = rm
+        self.name       = "Keithler 2450"
+        self.USBname    = USBname
+        self.deviceID   = USBname
+        self.logMessage = ''
+        self.parV0      = 0
+        self.parV1      = 2
+        self.parST      = 10
+        self.parDT      = 0.01
+        self.Vmax       = 50
+        self.STmax      = 2000
+        self.DTmin      = 0.01
+        self.DTmax      = 1
+        self.useBinary  = 1      # read the buffer as little-endian REAL, ASCII otherwise
+        self.readTimes  = 0      # also read the relative timestamps into data.T
+        self.pollMin    = 0.001  # status byte polling interval at the end of a sweep [s]
+        self.pollMax    = 0.02
+        self.sweepTmo   = 5      # extra time allowed on top of twice the sweep duration [s]
+        self.waitTime   = 0      # how long the last sweep took to complete [s]
+        self.streaming  = 0      # read the buffer in chunks while the sweep runs
+        self.chunkSize  = 100    # points per chunk in streaming mode
+        self.timing     = {}     # duration of the setup, wait and transfer of the last sweep [s]
+        self.state      = None   # settings known to be on the instrument, None when unknown
+        self.useTSP     = 0      # sweep with the TSP script when the instrument is in TSP mode
+        self.adaptive   = 0      # coarse linear pass, then a list sweep around the knee
+        self.screening  = None   # screening_criteria: stop the sweep once the verdict is known
+        self.screenSize = 10     # points per readback when screening
+        self.language   = "SCPI" # command set of the instrument, *LANG?
+        self.repeats    = 1      # sweeps averaged into one curve
+        self.nplc       = 1      # integration time of a reading [power line cycles]
+        self.filterCount = 1     # readings averaged per point by the repeat filter, 1 for no filter
+        self.lineFreq   = LINE_FREQUENCY
+        self.monitorBlock = MONITOR_BLOCK  # readings per trigger model run when monitoring
+        
+
+    # print all devices you can connect to
+    def printDevices(self):
+        print("I see the following devices:");
+        print(self.rm.list_resources())
+
+    #connect to the beloved Keithley
+    def connect(self):
+        self.resync()
+        try:
+            self.inst = self.rm.open_resource(self.USBname)
+            idn = self.inst.query('*IDN?')
+            self.logMessage = "I am connected to " + idn
+            # *IDN? answers "KEITHLEY INSTRUMENTS,MODEL 2450,<serial>,<firmware>"
+            fields = idn.split(",")
+            if len(fields) > 2: self.deviceID = fields[2].strip()
+            self.language = "SCPI"
+            if self.useTSP:
+                # the command set is chosen on the front panel (*LANG, then a reboot)
+                self.language = self.inst.query('*LANG?').strip().upper()
+                if self.language == "TSP":
+                    self.loadSweepScript()
+                else:
+                    self.logMessage += " (not in TSP mode, sweeping with SCPI)"
+            return 1
+        except:
+            self.logMessage = "Can't connect to device"
+            return 0
+        
+    #disconnect to the apparatus
+    def disconnect(self):
+        try:
+            self.inst.close()
+        except:
+            pass
+
+    #check we're still connected, pretty sure somebody will pull the cable...
+    def checkConnection(self):        
+        try:
+            self.inst.query('*IDN?')  
+        except:
+            self.message = "Apparatus disconnected - check connections and power"
+            self.resync()
+            return 0
+        return 1
+
+
+    #stop a running sweep and switch the output off. The device clear drops
+    #any pending *OPC? answer so the next sweep starts from a clean state
+    def abort(self):
+        self.resync()
+        self.inst.clear()
+        if self.language == "TSP":
+            self.inst.write("trigger.model.abort()\n")
+            self.inst.write("smu.source.output = smu.OFF\n")
+        else:
+            self.inst.write("ABOR\n")
+            self.inst.write("OUTP OFF\n")
+
+    #store the sweep script on the instrument and run it once, which defines
+    #k2450sweep for the following sweeps
+    def loadSweepScript(self):
+        self.inst.write("\n".join(["loadscript "+TSP_SCRIPT_NAME] + TSP_SWEEP_SCRIPT + ["endscript"]) + "\n")
+        self.inst.write(TSP_SCRIPT_NAME+".run()\n")
+
+    #forget the known settings, the next configure starts with *RST;*CLS.
+    #Called on connect and after anything that may leave the instrument in an
+    #unknown state (abort, errors, lost connection)
+    def resync(self):
+        self.state = None
+
+    #the instrument holds one sweep whatever command defined it, the cached
+    #definitions are dropped when another one (or a trigger model) replaces it
+    def forgetSweep(self):
+        if self.state is None: return
+        for header in [h for h in self.state if h.startswith("SOUR:SWE")]:
+            del self.state[header]
+
+    #bring the instrument to the given settings, a list of (header, value)
+    #pairs in the order they apply, sending only those that differ from the
+    #known state. A value of None marks a command sent every time at its
+    #place (e.g. a source list). A sweep (SOUR:SWE...) takes the source
+    #settings in force when it is defined, so it is sent again when anything
+    #before it is sent. commands are sent every time, after the settings.
+    #Everything goes out in one message, or a few of up to MAX_MESSAGE
+    #characters. Returns the number of commands sent
+    def configure(self,settings,commands=()):
+        messages = []
+        if self.state is None:
+            messages.append("*RST;*CLS")
+            self.state = {}
+        changed = []
+        for header, value in settings:
+            if value is None or self.state.get(header) != value or (changed and header.startswith("SOUR:SWE")):
+                changed.append((header,value))
+        messages += [header if value is None else "%s %s" % (header,value) for header, value in changed]
+        messages += list(commands)
+        if not messages: return 0
+
+        #common commands (*...) don't take the root colon
+        message = messages[0]
+        try:
+            for command in messages[1:]:
+                if len(message)+len(command)+2 > MAX_MESSAGE:
+                    self.inst.write(message+"\n")
+                    message = command
+                else:
+                    message += (";" if command.startswith("*") else ";:") + command
+            self.inst.write(message+"\n")
+        except:
+            self.resync()
+            raise
+        for header, value in changed:
+            if value is None: continue
+            if header.startswith("SOUR:SWE"): self.forgetSweep()
+            self.state[header] = value
+        return len(messages)
+
+    #time per point of a sweep: the delay and the (filtered) readings [s]
+    def pointTime(self):
+        return self.parDT + max(self.filterCount,1)*self.nplc/float(self.lineFreq)
+
+    #finally serious stuff, meaure IV curve
+    #task is an optional measurement_task used to report progress and to cancel.
+    #With repeats > 1 the sweep is run that many times and averaged, unless
+    #screening: a screening sweep stops early, its length varies
+    def measureIV(self,data,task=None):
+        data.Ierr, data.sweeps = None, 1
+        if self.repeats > 1 and self.screening is None:
+            return averageSweeps(self,data,task,self.measureIVOnce)
+        return self.measureIVOnce(data,task)
+
+    #a single sweep. Repeated sweeps are linear, the points of an adaptive
+    #sweep would move from one sweep to the next
+    def measureIVOnce(self,data,task=None):
+        if self.language == "TSP":
+            return self.measureIVTSP(data,task)
+        if self.adaptive and self.screening is None and self.repeats <= 1:
+            return self.measureIVAdaptive(data,task)
+        sweep = [("SOUR:SWE:VOLT:LIN", "%g, %g, %i, %.3f" % (self.parV0,self.parV1,self.parST,self.parDT))]
+        #screening reads the buffer while the sweep runs
+        done = self.runSweep(data,task,sweep,self.parST,self.streaming or self.screening is not None)
+        if done==1 and self.screening is not None:
+            data.verdict = self.screening.check(data.V,data.I,1)
+            self.logMessage = "Screening: %s after %i of %i points" % (data.verdict,data.V.size,self.parST)
+        return done
+
+
+    #adaptive sweep: a coarse linear pass with ADAPTIVE_COARSE of the parST
+    #points, then a list sweep (SOUR:LIST:VOLT) placing the others where the
+    #coarse curve bends, see adaptivePoints. Both passes are merged sorted by V
+    def measureIVAdaptive(self,data,task=None):
+        nCoarse = min(self.parST, max(3, int(round(self.parST*ADAPTIVE_COARSE))))
+        coarse  = data.__class__()
+        sweep   = [("SOUR:SWE:VOLT:LIN", "%g, %g, %i, %.3f" % (self.parV0,self.parV1,nCoarse,self.parDT))]
+        if self.runSweep(coarse,task,sweep,nCoarse)==0:
+            return 0
+        V, I, T = coarse.V, coarse.I, coarse.T
+        timing  = dict(self.timing)
+
+        #the list is sent rounded to 10 uV: a fine point that then repeats a
+        #coarse voltage or another fine point is dropped, the curve needs
+        #distinct voltages
+        fineV = np.unique(np.round(adaptivePoints(V, I, self.parST-nCoarse), 5))
+        fineV = fineV[~np.isin(fineV, np.round(V, 5))]
+        if fineV.size > 0:
+            #the list goes out in chunks, the 2450 takes a limited number of
+            #values per command
+            fine  = data.__class__()
+            sweep = [("SOUR:LIST:VOLT%s %s" % (":APP" if k else "", ",".join("%.5f" % v for v in fineV[k:k+LIST_CHUNK])), None)
+                     for k in range(0, fineV.size, LIST_CHUNK)]
+            sweep += [("SOUR:SWE:VOLT:LIST", "1, %.3f" % self.parDT)]
+            if self.runSweep(fine,task,sweep,fineV.size)==0:
+                return 0
+            for stage in timing: timing[stage] += self.timing[stage]
+            V = np.concatenate((V, fine.V))
+            I = np.concatenate((I, fine.I))
+            T = np.concatenate((T, fine.T+(T[-1] if T.size else 0)))
+
+        #sorted by V, a voltage read back twice keeps its first reading
+        order = np.argsort(V, kind='mergesort')
+        V, I, T = V[order], I[order], T[order]
+        keep  = np.concatenate(([True], np.diff(V) > 0))
+        data.V, data.I, data.T = V[keep], I[keep], T[keep]
+        self.timing     = timing
+        self.logMessage = "Adaptive sweep: %i coarse and %i fine points" % (nCoarse, fineV.size)
+        return 1
+
+
+    #integration time and repeat filter of every reading
+    def readingSettings(self):
+        settings = [("SENS:CURR:NPLC", "%g" % self.nplc)]
+        if self.filterCount > 1:
+            settings += [("SENS:CURR:AVER:TCON", "REP"),
+                         ("SENS:CURR:AVER:COUN", "%i" % self.filterCount),
+                         ("SENS:CURR:AVER",      "ON")]
+        else:
+            settings += [("SENS:CURR:AVER",      "OFF")]
+        return settings
+
+    #run the sweep defined by the settings in sweep, nPoints long, and read
+    #it into data
+    def runSweep(self,data,task,sweep,nPoints,streaming=0):
+        #prepare the measurement: only the settings that changed since the
+        #last sweep are sent, the buffer is cleared instead of a *RST
+        tStart = time.time()
+        settings = [("SENS:CURR:RANG:AUTO", "ON"),
+                    ("SOUR:FUNC",           "VOLT"),
+                    ("SOUR:VOLT:ILIM",      "1")] + sweep + self.readingSettings() + [
+                    ("*ESE",                "1")]
+        if self.useBinary:
+            settings += [("FORM:DATA", "REAL"), ("FORM:BORD", "SWAP")]
+        else:
+            settings += [("FORM:DATA", "ASC")]
+        try:
+            self.configure(settings, ["TRAC:CLE \"defbuffer1\"", "INIT", "*OPC"])
+            tSweep = time.time()
+
+            stopped = 0
+            if streaming:
+                stopped = self.streamSweep(data,task,tSweep,nPoints)
+                if stopped==0:
+                    return 0
+                stopped = (stopped==2)
+
+            if not stopped and (self.waitForSweep(task,tSweep,32,nPoints)==0):
+                return 0
+            tDone = time.time()
+
+            #retrieve data
+            if not streaming:
+                data.V, data.I, data.T = self.readBuffer(1,nPoints)
+
+            if not stopped: self.inst.write("OUTP OFF\n")
+        except:
+            self.resync()
+            raise
+        # in streaming mode most of the transfer is hidden in the wait
+        self.timing = {"setup": tSweep-tStart, "wait": tDone-tSweep, "transfer": time.time()-tDone}
+        return 1
+
+
+    #TSP sweep: a single call to the k2450sweep function loaded at connect().
+    #The answer only comes when the sweep is over, its arrival (MAV) is polled
+    #like the end of an SCPI sweep. No streaming in this mode
+    def measureIVTSP(self,data,task=None):
+        tStart = time.time()
+        try:
+            self.inst.write("k2450sweep(%g, %g, %i, %g, %i, %g, %i)\n" % (self.parV0,self.parV1,self.parST,self.parDT,
+                                                                         self.readTimes,self.nplc,self.filterCount))
+            tSweep = time.time()
+            if (self.waitForSweep(task,tSweep,16)==0):
+                return 0
+            tDone  = time.time()
+            values = self.inst.read_binary_values(datatype='d', is_big_endian=False, container=np.array)
+        except:
+            self.resync()
+            raise
+        values = values.reshape(-1,3 if self.readTimes else 2)
+        data.V = values[:,0].copy()
+        data.I = values[:,1].copy()
+        data.T = values[:,2].copy() if self.readTimes else np.zeros(values.shape[0])
+        self.timing = {"setup": tSweep-tStart, "wait": tDone-tSweep, "transfer": time.time()-tDone}
+        #the script runs to the end, the verdict comes after the full sweep
+        if self.screening is not None:
+            data.verdict = self.screening.check(data.V,data.I,1)
+        return 1
+
+
+    #wait for the end of the sweep started with INIT;*OPC. OPC sets bit 0 of the
+    #event status register, which *ESE 1 maps onto the ESB bit (32) of the status
+    #byte, so a serial poll tells us the sweep is over without blocking the bus.
+    #A TSP sweep is over when its answer is waiting, the MAV bit (16).
+    #We sleep through most of the expected sweep time, counted from tStart when
+    #given, then poll with an interval growing from pollMin to pollMax.
+    #Returns 1 when done, 0 if cancelled
+    def waitForSweep(self,task=None,tStart=None,bit=32,nPoints=None):
+        if nPoints is None: nPoints = self.parST
+        tExpected = nPoints*self.pointTime()
+        tTimeout  = 2*tExpected + self.sweepTmo
+        tPoll     = self.pollMin
+        if tStart is None: tStart = time.time()
+        while True:
+            elapsed = time.time()-tStart
+            if task is not None:
+                if task.isCancelled():
+                    self.abort()
+                    return 0
+                task.postProgress(elapsed/tExpected)
+
+            if elapsed < 0.9*tExpected:
+                time.sleep(min(0.1,0.9*tExpected-elapsed))
+                continue
+
+            if (self.inst.read_stb() & bit):
+                if bit == 32: self.inst.query("*ESR?\n")   # reading the ESR clears it for the next sweep
+                self.waitTime   = time.time()-tStart
+                self.logMessage   = "Sweep completed after %.3f s (expected %.3f s)" % (self.waitTime,tExpected)
+                return 1
+
+            if elapsed > tTimeout:
+                self.abort()
+                raise IOError("Sweep did not complete within %.1f s" % tTimeout)
+
+            time.sleep(tPoll)
+            tPoll = min(2*tPoll,self.pollMax)
+
+
+    #streaming readback: while the sweep runs, poll the buffer fill level with
+    #TRAC:ACT? and transfer the new points once chunkSize of them are available
+    #(or the sweep is complete). Points are appended to data as they arrive and
+    #posted to the task, so the transfer overlaps the acquisition and only the
+    #last chunk is left to read at the end. When screening, every chunk is
+    #checked and the sweep stopped as soon as the verdict is known.
+    #Returns 1 when done, 2 when stopped by the screening, 0 if cancelled
+    def streamSweep(self,data,task=None,tStart=None,nPoints=None):
+        if nPoints is None: nPoints = self.parST
+        tTimeout = 2*nPoints*self.pointTime() + self.sweepTmo
+        chunkSize = self.chunkSize if self.screening is None else min(self.chunkSize,self.screenSize)
+        if tStart is None: tStart = time.time()
+
+        V = np.zeros(nPoints)
+        I = np.zeros(nPoints)
+        T = np.zeros(nPoints)
+        nRead = 0
+        while nRead < nPoints:
+            if task is not None and task.isCancelled():
+                self.abort()
+                return 0
+
+            nDone = min(int(self.inst.query("TRAC:ACT? \"defbuffer1\"\n")),nPoints)
+            if nDone-nRead >= chunkSize or (nDone==nPoints and nDone>nRead):
+                V[nRead:nDone], I[nRead:nDone], T[nRead:nDone] = self.readBuffer(nRead+1,nDone)
+                nRead  = nDone
+                data.V = V[:nRead]
+                data.I = I[:nRead]
+                data.T = T[:nRead]
+                if task is not None:
+                    task.postProgress(float(nRead)/nPoints)
+                    task.postPartial(data.V,data.I)
+                if self.screening is not None and nRead < nPoints and self.screening.check(data.V,data.I):
+                    #*CLS also drops the pending *OPC, the settings stay valid
+                    self.inst.write("ABOR;:OUTP OFF;*CLS\n")
+                    return 2
+                continue
+
+            if time.time()-tStart > tTimeout:
+                self.abort()
+                raise IOError("Sweep stalled at %i of %i points" % (nDone,nPoints))
+
+            # sleep until the next window should be in the buffer
+            nNext = min(nRead+chunkSize,nPoints)
+            time.sleep(max(self.pollMin,min(0.1,(nNext-nDone)*self.pointTime())))
+
+        return 1
+
+
+    #hold voltage on the output and sample the current every parDT (plus the
+    #reading time) for duration seconds, None to run until cancelled. The
+    #SimpleLoop trigger model runs in blocks of monitorBlock readings and the
+    #buffer is read while it fills, like streamSweep. Every chunk (T,I), T in
+    #seconds from the start, is appended to log (a monitor_log) and posted to
+    #the task as a partial, nothing is kept here. SCPI only.
+    #Returns 1 when the duration is over, 0 if cancelled
+    def monitorI(self,voltage,task=None,log=None,duration=None):
+        if self.language == "TSP":
+            raise IOError("Monitoring needs the instrument in SCPI mode")
+        settings = [("SENS:CURR:RANG:AUTO", "ON"),
+                    ("SOUR:FUNC",           "VOLT"),
+                    ("SOUR:VOLT:ILIM",      "1"),
+                    ("SOUR:VOLT",           "%g" % voltage)] + self.readingSettings()
+        tRun   = time.time()
+        nTotal = 0
+        try:
+            while duration is None or time.time()-tRun < duration:
+                count = self.monitorBlock
+                if duration is not None:
+                    count = int(min(count, max(1, np.ceil((duration-(time.time()-tRun))/self.pointTime()))))
+                self.configure(settings, ["TRIG:LOAD \"SimpleLoop\", %i, %g" % (count,self.parDT),
+                                          "OUTP ON", "TRAC:CLE \"defbuffer1\"", "INIT"])
+                tBlock = time.time()-tRun
+                #the trigger model replaced the sweep, it is sent again next time
+                self.forgetSweep()
+
+                nRead = 0
+                tLast = time.time()
+                while nRead < count:
+                    if task is not None and task.isCancelled():
+                        self.abort()
+                        return 0
+                    nDone = min(int(self.inst.query("TRAC:ACT? \"defbuffer1\"\n")),count)
+                    if nDone-nRead >= self.chunkSize or (nDone==count and nDone>nRead):
+                        V, I, T = self.readBuffer(nRead+1,nDone,1)
+                        T     += tBlock
+                        nRead  = nDone
+                        nTotal += I.size
+                        tLast  = time.time()
+                        if log is not None: log.append(T,I)
+                        if task is not None:
+                            if duration: task.postProgress((tLast-tRun)/duration)
+                            task.postPartial(T,I)
+                        continue
+                    if time.time()-tLast > 2*self.chunkSize*self.pointTime() + self.sweepTmo:
+                        self.abort()
+                        raise IOError("Monitoring stalled at %i of %i readings" % (nDone,count))
+                    nNext = min(nRead+self.chunkSize,count)
+                    time.sleep(max(self.pollMin,min(0.1,(nNext-nDone)*self.pointTime())))
+            self.inst.write("OUTP OFF\n")
+        except:
+            self.resync()
+            raise
+        self.logMessage = "Monitored %g V for %.1f s: %i readings" % (voltage,time.time()-tRun,nTotal)
+        return 1
+
+
+    #retrieve points first..last of defbuffer1 with a single TRAC:DATA? request.
+    #The source, reading (and timestamp) columns come back interleaved, in binary
+    #REAL format when possible, ASCII if the binary transfer fails. withTimes
+    #overrides readTimes
+    def readBuffer(self,first,last,withTimes=None):
+        if withTimes is None: withTimes = self.readTimes
+        elements = "SOUR,READ"
+        if withTimes: elements += ",REL"
+        ncol   = len(elements.split(","))
+        buffer = "TRAC:DATA? %i,%i, \"defbuffer1\",%s\n" % (first,last,elements)
+
+        values = None
+        if self.useBinary:
+            try:
+                self.configure([("FORM:DATA", "REAL"), ("FORM:BORD", "SWAP")])
+                values = self.inst.query_binary_values(buffer, datatype='d', is_big_endian=False,
+                                                       container=np.array)
+            except:
+                self.useBinary  = 0
+                self.logMessage = "Binary buffer readback failed, using ASCII from now on"
+                self.inst.clear()
+
+        if values is None:
+            self.configure([("FORM:DATA", "ASC")])
+            values = np.array(self.inst.query_ascii_values(buffer))
+
+        values = values.reshape(-1,ncol)
+        times  = values[:,2].copy() if withTimes else np.zeros(values.shape[0])
+        return values[:,0].copy(), values[:,1].copy(), times
+
+
+
+
+
+
+
+
+
+
+# a set of instruments driven in parallel, one thread per instrument.
+# Instruments are found with discover() or passed in directly, e.g. a list of
+# keithley_2450_fake for testing. measureAll() runs one sweep on every unit,
+# run() spreads a list of jobs over whichever instrument is free.
+class instrument_pool():
+
+    def __init__(self, instruments=None):
+        self.instruments = list(instruments) if instruments is not None else []
+        self.logMessage  = ''
+        self.stopEvent   = threading.Event()
+
+    # open a session on every 2450 the resource manager can see
+    def discover(self, rm=None, pattern=KEITHLEY_2450_RESOURCES):
+        if rm is None:
+            import visa
+            rm = visa.ResourceManager()
+        known = [inst.USBname for inst in self.instruments if hasattr(inst,"USBname")]
+        for name in rm.list_resources(pattern):
+            if name not in known:
+                self.instruments.append(keithley_2450(name,rm))
+        return len(self.instruments)
+
+    # connect everything, keep only the instruments that answered
+    def connect(self):
+        connected = []
+        messages  = []
+        for inst in self.instruments:
+            if inst.connect()==1:
+                connected.append(inst)
+            messages.append(inst.logMessage)
+        self.instruments = connected
+        self.logMessage  = "\n".join(messages)
+        return len(connected)
+
+    def disconnect(self):
+        for inst in self.instruments:
+            inst.disconnect()
+
+    def stop(self):
+        self.stopEvent.set()
+
+    def deviceIDs(self):
+        return [inst.deviceID for inst in self.instruments]
+
+    # results and the jobs of an instrument are keyed by its deviceID, two
+    # instruments with the same one would lose results
+    def checkDeviceIDs(self):
+        IDs   = self.deviceIDs()
+        twice = sorted(set(ID for ID in IDs if IDs.count(ID) > 1))
+        if twice:
+            raise ValueError("Device ID %s used by more than one instrument of the pool" % ", ".join(twice))
+
+    # one sweep on every instrument at the same time. params is an optional
+    # dict of sweep settings (parV0, parV1, parST, parDT) applied to all of them.
+    # Returns {deviceID: {"status", "data", "message", "elapsed"}}
+    def measureAll(self, params=None):
+        self.checkDeviceIDs()
+        if params is not None:
+            for inst in self.instruments:
+                for key, value in params.items():
+                    setattr(inst, key, value)
+
+        results = {}
+        executor = futures.ThreadPoolExecutor(max_workers=max(1,len(self.instruments)))
+        try:
+            pending = dict((executor.submit(self.measureOne,inst), inst) for inst in self.instruments)
+            for future in futures.as_completed(pending):
+                results[pending[future].deviceID] = future.result()
+        finally:
+            executor.shutdown()
+        return results
+
+    def measureOne(self, inst):
+        result = {"status": 0, "data": data(), "message": "", "elapsed": 0}
+        tStart = time.time()
+        try:
+            result["status"]  = inst.measureIV(result["data"])
+            result["message"] = inst.logMessage
+        except Exception as e:
+            try:
+                inst.abort()
+            except:
+                pass
+            result["message"] = "Measurement failed on %s (%s)" % (inst.deviceID,e)
+        result["elapsed"] = time.time()-tStart
+        return result
+
+    # hand every job to the first free instrument: worker(inst, job) is called
+    # on the instrument's own thread. A job with a deviceID attribute only runs
+    # on that instrument. Returns a list of (deviceID, job, result) in completion
+    # order; a job whose worker raised gets the exception as result, and its
+    # instrument is aborted
+    def run(self, jobs, worker):
+        self.checkDeviceIDs()
+        shared  = queue.Queue()
+        own     = dict((inst.deviceID, queue.Queue()) for inst in self.instruments)
+        results = []
+        for job in jobs:
+            target = getattr(job,"deviceID",None)
+            if not target:
+                shared.put(job)
+            elif target in own:
+                own[target].put(job)
+            else:
+                results.append((target,job,ValueError("No instrument "+target+" in the pool")))
+        self.stopEvent.clear()
+
+        lock = threading.Lock()
+        def drain(inst):
+            while not self.stopEvent.is_set():
+                try:
+                    job = own[inst.deviceID].get_nowait()
+                except queue.Empty:
+                    try:
+                        job = shared.get_nowait()
+                    except queue.Empty:
+                        return
+                try:
+                    result = worker(inst,job)
+                except Exception as e:
+                    # switch the output off before the next job on this instrument
+                    try:
+                        inst.abort()
+                    except:
+                        pass
+                    result = e
+                with lock:
+                    results.append((inst.deviceID,job,result))
+
+        executor = futures.ThreadPoolExecutor(max_workers=max(1,len(self.instruments)))
+        try:
+            for f in [executor.submit(drain,inst) for inst in self.instruments]:
+                f.result()
+        except:
+            # e.g. Ctrl-C: let the running jobs finish but start no new one
+            self.stopEvent.set()
+            raise
+        finally:
+            executor.shutdown()
+        return results
+
+
@@ -0,0 +1,179 @@
+#
+# Columnar export of the measurement table for offline analysis: the metadata
+# columns and the V/I curves (as list<double> columns) of every entry, written
+# to Parquet or Arrow IPC files with pyarrow. ierr holds the standard errors of
+# averaged sweeps, it is empty for single sweeps.
+#
+# The table is read in id order, one chunk of entries at a time, and every
+# chunk becomes one record batch (a row group in Parquet), so memory stays at
+# one chunk whatever the size of the table. The output is a directory of part
+# files plus a state file holding the last exported id: the next run only
+# writes the entries added since, into a new part. Entries replaced in place
+# keep their id and are only picked up again by a --full export.
+#
+#     python keithley_2450_export.py --db sqlite:///measurements.db --output export/
+#     python keithley_2450_export.py --db sqlite:///measurements.db --output export/ --format arrow --full
+#
+# Read it back with pyarrow.dataset.dataset("export/") or pandas.read_parquet("export/").
+#
+from __future__ import print_function
+import os,sys,json,time,glob
+import argparse
+import numpy as np
+
+from keithley_2450_db import Entry, createDBEngine, CONNECT_TO_REAL_DB
+
+
+EXPORT_FORMATS = {"parquet": ".parquet", "arrow": ".arrow"}
+STATE_FILE     = "_export_state.json"
+
+METADATA_COLUMNS = ["id", "username", "sipmid", "date", "temperature", "v0", "v1", "steps", "deltat", "sweeps", "verdict"]
+
+
+
+def exportSchema():
+    import pyarrow as pa
+    return pa.schema([("id", pa.int64()), ("username", pa.string()), ("sipmid", pa.string()),
+                      ("date", pa.string()), ("temperature", pa.float64()), ("v0", pa.float64()),
+                      ("v1", pa.float64()), ("steps", pa.int32()), ("deltat", pa.float64()), ("sweeps", pa.int32()),
+                      ("verdict", pa.string()), ("v", pa.list_(pa.float64())), ("i", pa.list_(pa.float64())),
+                      ("ierr", pa.list_(pa.float64()))])
+
+
+# one record batch from a chunk of entries. The curves are concatenated once
+# and cut into lists by their offsets, no per-value Python objects
+def entryBatch(entries, schema):
+    import pyarrow as pa
+    columns = {}
+    for name in METADATA_COLUMNS:
+        columns[name] = pa.array([getattr(entry, name) for entry in entries], type=schema.field(name).type)
+    for name, attribute in (("v", "varray"), ("i", "iarray"), ("ierr", "ierrarray")):
+        arrays  = [getattr(entry, attribute) for entry in entries]
+        sizes   = [0 if values is None else values.size for values in arrays]
+        offsets = np.zeros(len(arrays)+1, dtype=np.int32)
+        np.cumsum(sizes, out=offsets[1:])
+        values  = np.concatenate([values for values in arrays if values is not None] or [np.empty(0)])
+        columns[name] = pa.ListArray.from_arrays(pa.array(offsets), pa.array(values.astype(np.float64, copy=False)))
+    return pa.RecordBatch.from_arrays([columns[field.name] for field in schema], schema=schema)
+
+
+def openWriter(filename, schema, fileFormat, compression):
+    import pyarrow as pa
+    if fileFormat == "parquet":
+        import pyarrow.parquet as pq
+        return pq.ParquetWriter(filename, schema, compression=compression)
+    options = pa.ipc.IpcWriteOptions(compression=None if compression == "none" else compression)
+    return pa.ipc.new_file(filename, schema, options=options)
+
+
+def readState(directory):
+    filename = os.path.join(directory, STATE_FILE)
+    if not os.path.exists(filename): return {"lastID": 0, "parts": 0}
+    f = open(filename, 'r')
+    try:
+        return json.load(f)
+    finally:
+        f.close()
+
+def writeState(directory, state):
+    filename = os.path.join(directory, STATE_FILE)
+    f = open(filename+".tmp", 'w')
+    json.dump(state, f)
+    f.flush()
+    os.fsync(f.fileno())
+    f.close()
+    os.rename(filename+".tmp", filename)   # atomic on POSIX, the state is never half written
+
+
+
+# export the entries not exported yet (all of them with full=1) to a new part
+# file in directory. Returns (entries, filename), filename None if there was
+# nothing new
+def exportEntries(Session, directory, fileFormat="parquet", chunkSize=1000, compression="zstd",
+                  full=0, log=print):
+    if fileFormat not in EXPORT_FORMATS:
+        raise ValueError("Unknown export format '%s'" % fileFormat)
+    import pyarrow   # fail before touching the output when it is missing
+    if not os.path.isdir(directory): os.makedirs(directory)
+    if full:
+        for filename in glob.glob(os.path.join(directory, "part-*")): os.remove(filename)
+        state = {"lastID": 0, "parts": 0}
+    else:
+        state = readState(directory)
+        if state.get("format", fileFormat) != fileFormat:
+            raise ValueError("%s holds a %s export, use --full to change the format" % (directory, state["format"]))
+        if state["parts"] > 0 and state.get("columns") != METADATA_COLUMNS:
+            raise ValueError("%s was exported with other columns, use --full to export it again" % directory)
+
+    schema   = exportSchema()
+    part     = "part-%05i%s" % (state["parts"], EXPORT_FORMATS[fileFormat])
+    filename = os.path.join(directory, part)
+    writer   = None
+    lastID   = state["lastID"]
+    count    = 0
+    nbytes   = 0
+    tStart   = time.time()
+    session  = Session()
+    try:
+        while True:
+            entries = session.query(Entry).filter(Entry.id > lastID).order_by(Entry.id).limit(chunkSize).all()
+            if not entries: break
+            batch = entryBatch(entries, schema)
+            if writer is None:
+                # the part only exists while it is written, a crash leaves a .tmp behind
+                writer = openWriter(filename+".tmp", schema, fileFormat, compression)
+            if fileFormat == "parquet":
+                writer.write_table(pyarrow.Table.from_batches([batch]))
+            else:
+                writer.write_batch(batch)
+            lastID  = entries[-1].id
+            count  += len(entries)
+            nbytes += batch.nbytes
+            session.expunge_all()   # drop the chunk, the session would keep every entry
+            log("%i entries exported (%.0f entries/s, %.1f MB)" % (count, count/max(time.time()-tStart,1e-6), nbytes/1e6))
+    except:
+        if writer is not None:
+            writer.close()
+            os.remove(filename+".tmp")
+        raise
+    finally:
+        session.close()
+
+    if writer is None: return 0, None
+    writer.close()
+    os.rename(filename+".tmp", filename)
+    writeState(directory, {"lastID": lastID, "parts": state["parts"]+1, "format": fileFormat, "columns": METADATA_COLUMNS})
+    return count, filename
+
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="Export the measurement table to Parquet or Arrow files")
+    parser.add_argument("--db", default=None, help="SQLAlchemy database URL (default: the configured database)")
+    parser.add_argument("--output", required=True, help="export directory, one part file per run")
+    parser.add_argument("--format", default="parquet", choices=sorted(EXPORT_FORMATS), help="file format")
+    parser.add_argument("--chunk", type=int, default=1000, help="entries per record batch")
+    parser.add_argument("--compression", default="zstd", help="codec (zstd, snappy, lz4, none)")
+    parser.add_argument("--full", action="store_true", help="export every entry again, replacing the old parts")
+    args = parser.parse_args(argv)
+
+    if args.db is None and not CONNECT_TO_REAL_DB:
+        parser.error("no database configured, give one with --db")
+
+    engine, Session = createDBEngine(args.db)
+    tStart = time.time()
+    try:
+        count, filename = exportEntries(Session, args.output, args.format, args.chunk, args.compression, args.full)
+    except (ValueError, IOError, OSError) as e:
+        print("ERROR: Export failed ("+str(e)+")")
+        return 1
+    if filename is None:
+        print("Nothing new to export")
+    else:
+        print("Exported %i entries to %s in %.1f s" % (count, filename, time.time()-tStart))
+    return 0
+
+
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -0,0 +1,212 @@
+#
+# Bulk import of measurement files written by data.write (the text format,
+# .npz containers too) into the Entry table, the command line version of
+# File->Open followed by Export for a whole directory tree.
+#
+# The tree is walked for files matching the pattern and the files are read,
+# hashed and parsed in a process pool, a group of files per task. The parsed
+# measurements are written here in batches, one writeEntries transaction
+# each, with the replace rule of the GUI export (same device ID and date).
+# The SHA-256 of every imported file goes to the import table
+# (ImportedFile): a file whose content was imported before is skipped,
+# whatever its path, so runs are incremental. The hashes are committed after
+# their batch, a batch written twice after a crash is replaced in place.
+# A file that can't be read, or whose entry the database rejects, is
+# reported and counted as failed, the run goes on.
+#
+#     python keithley_2450_import.py --db sqlite:///measurements.db /mnt/shared/iv
+#     python keithley_2450_import.py --db sqlite:///measurements.db --pattern '*.npz' --workers 8 data/
+#
+from __future__ import print_function
+import os,sys,io,time,fnmatch,hashlib,multiprocessing
+import argparse
+
+from keithley_2450_core import data, dateString
+from keithley_2450_db import ImportedFile, createDBEngine, writeEntries, isRowError, export_record, CONNECT_TO_REAL_DB
+
+
+FILES_PER_TASK = 50   # files parsed by a worker per task
+
+
+
+# the files under the directories (or given directly) matching pattern, sorted
+def findFiles(paths, pattern="*.txt"):
+    files = []
+    for path in paths:
+        if os.path.isfile(path):
+            files.append(path)
+            continue
+        for directory, subdirectories, filenames in os.walk(path):
+            subdirectories.sort()
+            files += [os.path.join(directory, name) for name in sorted(filenames) if fnmatch.fnmatch(name, pattern)]
+    return files
+
+
+# runs in a worker: read, hash and parse a group of files. Returns one
+# (path, sha256, size, record, error) per file, record an export_record of
+# the measurement and its sweep settings, None with the error message when
+# the file can't be read
+def parseFiles(paths):
+    results = []
+    for path in paths:
+        digest, size, record, error = None, 0, None, None
+        try:
+            f = open(path, 'rb')
+            try:
+                raw = f.read()
+            finally:
+                f.close()
+            size     = len(raw)
+            digest   = hashlib.sha256(raw).hexdigest()
+            settings = export_record()
+            measurement = data()
+            measurement.readStream(io.BytesIO(raw), settings, path)
+            record   = export_record(measurement, settings)
+        except (IOError, OSError, ValueError) as e:
+            error = str(e)
+        except Exception as e:
+            # anything else the parser raises only fails this file, never the run
+            error = "%s: %s (%s)" % (path, e, e.__class__.__name__)
+        results.append((path, digest, size, record, error))
+    return results
+
+
+# the hashes among digests already in the import table
+def importedHashes(session, digests):
+    digests = list(digests)
+    known   = set()
+    for start in range(0, len(digests), 500):
+        known.update(digest for digest, in session.query(ImportedFile.sha256)
+                                                  .filter(ImportedFile.sha256.in_(digests[start:start+500])))
+    return known
+
+
+# store a batch of parsed files: the entries in one writeEntries transaction,
+# then their hashes. Returns the number of entries inserted and replaced
+def writeBatch(session, batch):
+    inserted, replaced = writeEntries(session, [(record, record) for path, digest, record in batch])
+    try:
+        now = dateString()
+        session.bulk_insert_mappings(ImportedFile, [{"sha256": digest, "path": path[-500:], "sipmid": record.sipmID,
+                                                     "date": record.date, "imported": now}
+                                                    for path, digest, record in batch])
+        session.commit()
+    except:
+        session.rollback()
+        raise
+    return inserted, replaced
+
+
+
+# import the files under paths into the database at url. workers=0 parses in
+# this process. Returns a dict of counts: files, imported, inserted,
+# replaced, skipped, failed
+def importFiles(url, paths, pattern="*.txt", workers=None, batchSize=500, log=print):
+    files = findFiles(paths, pattern)
+    tasks = [files[k:k+FILES_PER_TASK] for k in range(0, len(files), FILES_PER_TASK)]
+    log("%i files to read" % len(files))
+
+    engine, Session = createDBEngine(url)
+    session = Session()
+    counts  = {"files": len(files), "imported": 0, "inserted": 0, "replaced": 0, "skipped": 0, "failed": 0}
+    state   = {"batch": [], "hashes": set(), "bytes": 0, "done": 0}
+    tStart  = time.time()
+
+    def flush():
+        batch = state["batch"]
+        if not batch: return
+        known = importedHashes(session, [digest for path, digest, record in batch])
+        new   = [item for item in batch if item[1] not in known]
+        counts["skipped"] += len(batch)-len(new)
+        try:
+            written = [(new, writeBatch(session, new))] if new else []
+        except Exception as e:
+            if not isRowError(e): raise
+            # an entry the database rejects fails its file only: the batch
+            # goes again file by file
+            written = []
+            for item in new:
+                try:
+                    written.append(([item], writeBatch(session, [item])))
+                except Exception as e:
+                    if not isRowError(e): raise
+                    counts["failed"] += 1
+                    log("ERROR: %s: rejected by the database (%s)" % (item[0], e))
+        for items, (inserted, replaced) in written:
+            counts["imported"] += len(items)
+            counts["inserted"] += inserted
+            counts["replaced"] += replaced
+        state["batch"] = []
+        elapsed = max(time.time()-tStart, 1e-6)
+        log("%i of %i files read, %i imported, %i skipped, %i failed (%.0f files/s, %.1f MB/s)" %
+            (state["done"], len(files), counts["imported"], counts["skipped"], counts["failed"],
+             state["done"]/elapsed, state["bytes"]/elapsed/1e6))
+
+    def collect(results):
+        for path, digest, size, record, error in results:
+            state["done"]  += 1
+            state["bytes"] += size
+            if error is not None:
+                counts["failed"] += 1
+                log("ERROR: %s" % error)   # the messages name the file
+            elif digest in state["hashes"]:
+                counts["skipped"] += 1   # the same content twice in this run
+            else:
+                state["hashes"].add(digest)
+                state["batch"].append((path, digest, record))
+        if len(state["batch"]) >= batchSize: flush()
+
+    try:
+        if workers == 0:
+            for task in tasks:
+                collect(parseFiles(task))
+        else:
+            from concurrent.futures import ProcessPoolExecutor
+            workers = workers or multiprocessing.cpu_count()
+            pool    = ProcessPoolExecutor(workers)
+            try:
+                # keep a few tasks in flight per worker, the results are
+                # stored here in order as they come in
+                pending = []
+                for task in tasks:
+                    pending.append(pool.submit(parseFiles, task))
+                    if len(pending) >= 2*workers:
+                        collect(pending.pop(0).result())
+                for future in pending:
+                    collect(future.result())
+            finally:
+                pool.shutdown()
+        flush()
+    finally:
+        session.close()
+        engine.dispose()
+
+    elapsed = max(time.time()-tStart, 1e-6)
+    log("%i files in %.1f s (%.0f files/s): %i imported (%i new entries, %i replaced), %i already imported, %i failed" %
+        (len(files), elapsed, len(files)/elapsed, counts["imported"], counts["inserted"], counts["replaced"],
+         counts["skipped"], counts["failed"]))
+    return counts
+
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="Import measurement files written by the GUI into the database")
+    parser.add_argument("paths", nargs="+", help="directories to walk, or single files")
+    parser.add_argument("--db", default=None, help="SQLAlchemy database URL (default: the configured database)")
+    parser.add_argument("--pattern", default="*.txt", help="file name pattern (default: *.txt)")
+    parser.add_argument("--workers", type=int, default=None, help="worker processes, 0 to parse in this process (default: one per CPU)")
+    parser.add_argument("--batch", type=int, default=500, help="entries per transaction")
+    args = parser.parse_args(argv)
+
+    if args.db is None and not CONNECT_TO_REAL_DB:
+        parser.error("no database configured, give one with --db")
+    for path in args.paths:
+        if not os.path.exists(path): parser.error("%s does not exist" % path)
+
+    counts = importFiles(args.db, args.paths, args.pattern, args.workers, args.batch)
+    return 1 if counts["failed"] else 0
+
+
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -0,0 +1,85 @@
+#
+# Convert the V/I arrays of an existing measurement table from the old pickled
+# columns to the typed binary storage of keithley_2450_db (SQLArray).
+#
+# Rows are walked in id order in batches. Every pickled array is unpickled
+# once, here, and rewritten with encodeArray in a bulk UPDATE, one transaction
+# per batch. Rows already converted are skipped, so the tool can be stopped
+# and run again. Only run it on a database whose pickles you trust.
+#
+#     python keithley_2450_migrate.py --db mysql+mysqldb://user:pw@host/testdb
+#     python keithley_2450_migrate.py --db sqlite:///measurements.db --dtype '<f4' --dry-run
+#
+from __future__ import print_function
+import sys,time,pickle
+import argparse
+import numpy as np
+
+from sqlalchemy import MetaData, Table, Column, Integer, LargeBinary, bindparam
+
+from keithley_2450_db import TABLE_NAME, ARRAY_MAGIC, ARRAY_STORAGE_DTYPE, encodeArray, createDBEngine
+
+
+
+def unpickleArray(blob):
+    try:
+        values = pickle.loads(blob)
+    except UnicodeDecodeError:
+        # pickled by Python 2
+        values = pickle.loads(blob, encoding='latin1')
+    return np.asarray(values, dtype=float)
+
+
+# convert every pickled row, returns (converted, skipped)
+def migrate(engine, batchSize=1000, dtype=ARRAY_STORAGE_DTYPE, dryRun=0, log=print):
+    table = Table(TABLE_NAME, MetaData(),
+                  Column('id', Integer, primary_key=True),
+                  Column('varray', LargeBinary),
+                  Column('iarray', LargeBinary))
+    update = table.update().where(table.c.id == bindparam('_id')).values(varray=bindparam('_v'), iarray=bindparam('_i'))
+
+    converted = 0
+    skipped   = 0
+    lastID    = 0
+    tStart    = time.time()
+    while True:
+        with engine.begin() as connection:
+            rows = connection.execute(table.select().where(table.c.id > lastID)
+                                      .order_by(table.c.id).limit(batchSize)).fetchall()
+            if not rows: break
+            lastID = rows[-1][0]
+
+            changes = []
+            for rowID, varray, iarray in rows:
+                if varray is None or bytes(varray[:4]) == ARRAY_MAGIC:
+                    skipped += 1
+                    continue
+                changes.append({"_id": rowID,
+                                "_v": encodeArray(unpickleArray(varray), dtype),
+                                "_i": encodeArray(unpickleArray(iarray), dtype)})
+            if changes and not dryRun:
+                connection.execute(update, changes)
+            converted += len(changes)
+        log("up to id %i: %i converted, %i already done (%.0f rows/s)" %
+            (lastID, converted, skipped, (converted+skipped)/max(time.time()-tStart,1e-6)))
+    return converted, skipped
+
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="Convert pickled V/I arrays to the typed binary storage")
+    parser.add_argument("--db", default=None, help="SQLAlchemy database URL (default: the configured database)")
+    parser.add_argument("--batch", type=int, default=1000, help="rows per transaction")
+    parser.add_argument("--dtype", default=ARRAY_STORAGE_DTYPE, choices=["<f8","<f4"], help="stored value type")
+    parser.add_argument("--dry-run", action="store_true", help="decode everything but write nothing")
+    args = parser.parse_args(argv)
+
+    engine, Session = createDBEngine(args.db)
+    converted, skipped = migrate(engine, args.batch, args.dtype, args.dry_run)
+    print("%s %i rows, %i were already converted" % ("Would convert" if args.dry_run else "Converted", converted, skipped))
+    return 0
+
+
+
+if __name__ == "__main__":
+    sys.exit(main())
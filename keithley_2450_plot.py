@@ -0,0 +1,203 @@
+#
+# Drawing of the IV curves on a matplotlib figure. Works with any canvas, the
+# GUI draws on TkAgg, the benchmarks on Agg.
+#
+import numpy as np
+
+
+MAX_PLOT_POINTS = 2000   # curves longer than this are decimated for display
+RING_SIZE       = 100000 # samples of a monitoring run kept for the live plot
+
+
+
+# draw the points and a cubic interpolation through them, returns the
+# interpolating function
+def plotIV(figure, plotter, data, nsteps):
+    from scipy.interpolate import interp1d
+    plotter.clear()
+    finterp = interp1d(data.V,data.I, kind='cubic')
+    xnew = np.linspace(data.V[0], data.V[-1], num=max(nsteps,100), endpoint=True)
+    plotter.plot(data.V,data.I,'o',xnew,finterp(xnew),'-')
+    #plotter.plot(data.V,data.I)
+    plotter.set_xlabel("V [V]")
+    plotter.set_ylabel("I [A]")
+    figure.suptitle("I-V curve for " + data.sipmID, fontsize=14, fontweight='bold')
+    return finterp
+
+
+
+# reduce a curve to at most maxPoints for display, keeping the lowest and the
+# highest y of every bucket so spikes and steps stay visible
+def decimate(x, y, maxPoints=MAX_PLOT_POINTS):
+    x = np.asarray(x)
+    y = np.asarray(y)
+    if x.size <= maxPoints: return x, y
+    keep = decimationIndices(y, maxPoints)
+    return x[keep], y[keep]
+
+# the indices of the points decimate keeps
+def decimationIndices(y, maxPoints=MAX_PLOT_POINTS):
+    y = np.asarray(y)
+    if y.size <= maxPoints: return np.arange(y.size)
+    # buckets of equal width, the remainder goes in the last one
+    width  = y.size//(maxPoints//2)
+    nbins  = y.size//width
+    starts = np.arange(nbins)*width
+    blocks = y[:nbins*width].reshape(nbins, width)
+    lo     = starts+blocks.argmin(axis=1)
+    hi     = starts+blocks.argmax(axis=1)
+    if nbins*width < y.size:
+        tail = y[nbins*width:]
+        lo   = np.append(lo, nbins*width+tail.argmin())
+        hi   = np.append(hi, nbins*width+tail.argmax())
+    return np.unique(np.concatenate((lo, hi)))
+
+
+
+# the latest capacity samples of a monitoring run, in arrays allocated once
+# and written round robin. view() returns them in time order and decimated
+# to maxPoints, so memory and redraw cost stay the same after a minute or a
+# day of monitoring. The full run is on disk (monitor_log)
+class sample_ring():
+
+    def __init__(self, capacity=RING_SIZE):
+        self.capacity = capacity
+        self.T        = np.zeros(capacity)
+        self.I        = np.zeros(capacity)
+        self.head     = 0   # where the next sample goes
+        self.size     = 0
+        self.total    = 0   # samples seen, including those overwritten
+
+    def append(self, T, I):
+        self.total += np.size(T)
+        T = np.asarray(T, dtype=float)[-self.capacity:]
+        I = np.asarray(I, dtype=float)[-self.capacity:]
+        index = (self.head+np.arange(T.size)) % self.capacity
+        self.T[index] = T
+        self.I[index] = I
+        self.head = (self.head+T.size) % self.capacity
+        self.size = min(self.size+T.size, self.capacity)
+
+    def ordered(self):
+        if self.size < self.capacity: return self.T[:self.size], self.I[:self.size]
+        return np.concatenate((self.T[self.head:], self.T[:self.head])), \
+               np.concatenate((self.I[self.head:], self.I[:self.head]))
+
+    def view(self, maxPoints=MAX_PLOT_POINTS):
+        T, I = self.ordered()
+        return decimate(T, I, maxPoints)
+
+
+
+# keeps the artists of the IV plot and updates them in place. A new dataset
+# redraws the figure once (limits, title), refreshes of the same or a growing
+# dataset only blit the data region. The cubic smoothing is computed once per
+# dataset and skipped for live curves. The mean of repeated sweeps is drawn
+# with error bars of its standard error (data.Ierr)
+class iv_renderer():
+
+    def __init__(self, figure, plotter, canvas, maxPoints=MAX_PLOT_POINTS):
+        self.figure     = figure
+        self.plotter    = plotter
+        self.canvas     = canvas
+        self.maxPoints  = maxPoints
+        self.title      = None
+        self.dataV      = None    # the arrays the smoothing was computed for
+        self.dataI      = None
+        self.finterp    = None
+        self.dataIerr   = None
+        self.background = None
+        plotter.clear()
+        plotter.set_xlabel("V [V]")
+        plotter.set_ylabel("I [A]")
+        # animated artists are left out of canvas.draw() and drawn on top of the
+        # saved background instead, savefig still includes them
+        self.points, = plotter.plot([], [], 'o', animated=True)
+        self.smooth, = plotter.plot([], [], '-', animated=True)
+        from matplotlib.collections import LineCollection
+        self.errors  = LineCollection([], colors=self.points.get_color(), linewidths=1, animated=True)
+        plotter.add_collection(self.errors)
+        canvas.mpl_connect('draw_event', self.onDraw)
+
+    def onDraw(self, event):
+        self.background = self.canvas.copy_from_bbox(self.plotter.bbox)
+        self.drawArtists()
+
+    def drawArtists(self):
+        self.plotter.draw_artist(self.errors)
+        self.plotter.draw_artist(self.points)
+        self.plotter.draw_artist(self.smooth)
+
+    # live: the curve of a running sweep, drawn without smoothing inside xRange
+    # (the sweep range) so the axes don't move with every new point. title
+    # and xLabel replace those of an IV curve, e.g. for the I(t) of a
+    # monitoring run. Returns the interpolating function, None for live curves
+    def refresh(self, data, nsteps, live=0, xRange=None, title=None, xLabel="V [V]"):
+        V = np.asarray(data.V, dtype=float)
+        I = np.asarray(data.I, dtype=float)
+        newData = not (data.V is self.dataV and data.I is self.dataI)
+
+        if newData:
+            self.dataV, self.dataI = data.V, data.I
+            self.finterp = None
+            xs = ys = np.empty(0)
+            if not live and V.size >= 4:
+                from scipy.interpolate import interp1d
+                self.finterp = interp1d(V, I, kind='cubic')
+                xs = np.linspace(V[0], V[-1], num=min(max(nsteps,100),self.maxPoints), endpoint=True)
+                ys = self.finterp(xs)
+            keep = decimationIndices(I, self.maxPoints)
+            self.points.set_data(V[keep], I[keep])
+            self.smooth.set_data(xs, ys)
+            self.dataIerr = None
+            Ierr = getattr(data, "Ierr", None)
+            if Ierr is not None and np.size(Ierr) == V.size:
+                self.dataIerr = np.asarray(Ierr, dtype=float)
+                x, y, e = V[keep], I[keep], self.dataIerr[keep]
+                self.errors.set_segments(np.stack((np.column_stack((x, y-e)), np.column_stack((x, y+e))), axis=1))
+            else:
+                self.errors.set_segments([])
+
+        if title is None: title = "I-V curve for " + data.sipmID
+        if xLabel != self.plotter.get_xlabel():
+            self.plotter.set_xlabel(xLabel)
+            self.title = None   # forces the full redraw
+        # rescale first, a new title must not skip it
+        rescaled = self.rescale(V, I, live, xRange, newData)
+        if self.background is None or title != self.title or rescaled:
+            if title != self.title:
+                self.figure.suptitle(title, fontsize=14, fontweight='bold')
+                self.title = title
+            self.canvas.draw()
+        else:
+            self.canvas.restore_region(self.background)
+            self.drawArtists()
+            self.canvas.blit(self.plotter.bbox)
+        return self.finterp
+
+    # set new axis limits when the curve needs them, returns 1 if they changed
+    def rescale(self, V, I, live, xRange, newData):
+        if V.size == 0: return 0
+        if not live:
+            if not newData: return 0
+            self.plotter.set_autoscale_on(True)   # set_xlim/set_ylim of a live curve switched it off
+            self.plotter.relim()
+            if self.dataIerr is not None:
+                # relim leaves collections out, make room for the error bars
+                self.plotter.update_datalim(np.column_stack((np.concatenate((V, V)),
+                                                             np.concatenate((I-self.dataIerr, I+self.dataIerr)))))
+            self.plotter.autoscale_view()
+            return 1
+        x0, x1 = xRange if xRange is not None else (V.min(), V.max())
+        y0, y1 = self.plotter.get_ylim()
+        changed = 0
+        if self.plotter.get_xlim() != (x0, x1) and x1 > x0:
+            self.plotter.set_xlim(x0, x1)
+            changed = 1
+        ymin, ymax = I.min(), I.max()
+        if changed or ymin < y0 or ymax > y1:
+            # leave headroom so a rising curve doesn't need a redraw per point
+            span = max(ymax-ymin, abs(ymax), 1e-12)
+            self.plotter.set_ylim(ymin-0.05*span, ymax+span)
+            changed = 1
+        return changed
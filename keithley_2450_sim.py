@@ -0,0 +1,492 @@
+#
+# SCPI level simulator of a Keithley 2450 for offline profiling and testing.
+#
+# sim_2450 stands in for the VISA resource: it takes the SCPI strings the real
+# driver sends (*RST, SOUR:SWE:VOLT:LIN, SOUR:LIST:VOLT, INIT, *OPC, TRAC:ACT?, TRAC:DATA?, ...),
+# runs the sweep in real time against a SiPM model and charges every transfer a
+# latency plus its size over the bus bandwidth. sim_resource_manager plays the
+# part of visa.ResourceManager, so the driver runs unchanged:
+#
+#     rm   = sim_resource_manager(2)
+#     inst = keithley_2450(rm.list_resources()[0], rm)
+#     inst.connect()
+#     inst.measureIV(data())
+#
+# With language="TSP" the unit behaves like a 2450 switched to TSP: it stores
+# scripts sent with loadscript/endscript and, once run, knows the functions
+# they define. The simulator can't run Lua, it has its own implementation of
+# the functions it knows by name (k2450sweep, the sweep script of the driver).
+#
+# Run as a script it checks the driver against the simulator, sweep sequences
+# that went wrong before included:
+#
+#     python keithley_2450_sim.py
+#
+from __future__ import print_function
+import re,sys,time,fnmatch,struct,threading
+import numpy as np
+
+
+
+# reverse biased SiPM: a leakage current below breakdown, then a current
+# growing with the square of the overvoltage. The knee is smoothed over
+# vSmooth so the curve and its derivatives stay continuous.
+class sipm_model():
+
+    def __init__(self, vbd=24.5, leakage=1e-10, vLeak=20.0, gain=2e-7, vSmooth=0.1,
+                 noise=0.01, noiseFloor=1e-12, seed=None):
+        self.vbd        = vbd          # breakdown voltage [V]
+        self.leakage    = leakage      # leakage current at 0 V [A]
+        self.vLeak      = vLeak        # the leakage grows by e every vLeak volts
+        self.gain       = gain         # current per squared volt of overvoltage [A/V^2]
+        self.vSmooth    = vSmooth      # width of the knee [V]
+        self.noise      = noise        # relative noise on every reading
+        self.noiseFloor = noiseFloor   # absolute noise on every reading [A]
+        self.random     = np.random.RandomState(seed)
+
+    def current(self, V):
+        V  = np.asarray(V, dtype=float)
+        dV = self.vSmooth*np.logaddexp(0, (V-self.vbd)/self.vSmooth)
+        return self.leakage*np.exp(V/self.vLeak) + self.gain*dV*dV
+
+    def measure(self, V):
+        I = self.current(V)
+        return I*(1+self.noise*self.random.standard_normal(I.shape)) + \
+               self.noiseFloor*self.random.standard_normal(I.shape)
+
+
+
+# normalize a SCPI header node to its short form: the first four letters,
+# or three when the fourth is a vowel (SOURce -> SOUR, SWEep -> SWE)
+def shortForm(node):
+    node = node.strip().upper()
+    while node and node[-1].isdigit(): node = node[:-1]
+    if len(node) <= 4: return node
+    return node[:3] if node[3] in "AEIOU" else node[:4]
+
+
+
+class sim_2450():
+
+    def __init__(self, resourceName="USB0::0x05E6::0x2450::SIM00000::INSTR", model=None,
+                 latency=0.5e-3, bandwidth=1e6, commandTime=0.2e-3, resetTime=0.1,
+                 lineFreq=50, strict=1, language="SCPI"):
+        self.resource_name = resourceName
+        self.serial      = resourceName.split("::")[3] if resourceName.count("::") >= 4 else "SIM00000"
+        self.model       = model if model is not None else sipm_model()
+        self.latency     = latency       # per message, both directions [s]
+        self.bandwidth   = bandwidth     # bus throughput [bytes/s]
+        self.commandTime = commandTime   # parsing time per command [s]
+        self.resetTime   = resetTime     # *RST [s]
+        self.lineFreq    = lineFreq      # sets the integration time of 1 PLC
+        self.strict      = strict        # raise on commands the simulator does not know
+        self.timeout     = 2000          # VISA timeout [ms], like pyvisa
+        self.lock        = threading.Lock()
+        self.output      = []            # answers waiting to be read
+        self.errors      = []
+        self.written     = []            # every command received, for tests
+        self.language    = language      # "SCPI" or "TSP", answered by *LANG?
+        self.scripts     = {}            # TSP scripts by name, as lists of lines
+        self.functions   = set()         # TSP functions defined by the scripts run
+        self.loading     = None          # (name, lines) of the script being loaded
+        self.reset()
+        self.clearBuffer()
+
+    #---------------------------------------------------------------------------------
+    # instrument state
+    def reset(self):
+        self.settings = {"SENS:CURR:RANG:AUTO": "ON", "SOUR:FUNC": "VOLT", "SOUR:VOLT": "0", "SOUR:VOLT:ILIM": "0.000105",
+                         "SENS:CURR:NPLC": "1", "SENS:CURR:AVER": "OFF", "SENS:CURR:AVER:COUN": "10",
+                         "SENS:CURR:AVER:TCON": "REP", "FORM:DATA": "ASC", "FORM:BORD": "SWAP"}
+        self.sweep    = None
+        self.sourceList = np.zeros(0)
+        self.ese      = 0
+        self.esr      = 0
+        self.opcArmed = 0
+        self.outputOn = 0
+        self.sweepEnd = 0
+        self.clearBuffer()
+
+    def clearBuffer(self):
+        self.bufV     = np.zeros(0)
+        self.bufI     = np.zeros(0)
+        self.bufT     = np.zeros(0)     # time the reading is taken, relative to the first one
+        self.bufReady = np.zeros(0)     # wall clock time the reading lands in the buffer
+        self.bufStart = None
+
+    def ilim(self):
+        return float(self.settings["SOUR:VOLT:ILIM"])
+
+    # readings averaged into one by the filter
+    def filterCount(self):
+        if self.settings["SENS:CURR:AVER"] not in ("ON","1"): return 1
+        return max(1, int(self.settings["SENS:CURR:AVER:COUN"]))
+
+    # time to take one (filtered) reading at the current NPLC
+    def measureTime(self):
+        return self.filterCount()*float(self.settings["SENS:CURR:NPLC"])/self.lineFreq
+
+    def count(self, now=None):
+        if now is None: now = time.time()
+        return int(np.searchsorted(self.bufReady, now, side='right'))
+
+    def running(self, now=None):
+        if now is None: now = time.time()
+        return self.sweepEnd > now
+
+    # start the configured sweep: the readings are drawn now and each one
+    # becomes visible in the buffer when its dwell time has passed
+    def initiate(self, now):
+        if self.sweep is None:
+            self.error(-221, "Settings conflict; no sweep configured")
+            return
+        V, delay = self.sweep
+        step  = delay + self.measureTime()
+        ready = now + step*np.arange(1, V.size+1)
+        n     = self.filterCount()
+        I     = np.clip(self.model.measure(np.repeat(V, n)).reshape(V.size, n).mean(axis=1), -self.ilim(), self.ilim())
+        if self.bufStart is None: self.bufStart = now
+        self.bufV     = np.append(self.bufV, V)
+        self.bufI     = np.append(self.bufI, I)
+        self.bufT     = np.append(self.bufT, ready-self.bufStart)
+        self.bufReady = np.append(self.bufReady, ready)
+        self.sweepEnd = ready[-1]
+        self.outputOn = 1
+
+    def abort(self, now):
+        n = self.count(now)
+        self.bufV, self.bufI, self.bufT, self.bufReady = self.bufV[:n], self.bufI[:n], self.bufT[:n], self.bufReady[:n]
+        self.sweepEnd = min(self.sweepEnd, now)
+
+    # OPC is set once the sweep running when *OPC was received is over
+    def updateStatus(self, now):
+        if self.opcArmed and not self.running(now):
+            self.esr |= 1
+            self.opcArmed = 0
+
+    def error(self, code, text):
+        self.errors.append("%i,\"%s\"" % (code,text))
+        if self.strict: raise ValueError("SCPI error %i: %s" % (code,text))
+
+    #---------------------------------------------------------------------------------
+    # transport
+    def transfer(self, nbytes):
+        time.sleep(self.latency + nbytes/float(self.bandwidth))
+
+    def write(self, message):
+        self.transfer(len(message))
+        with self.lock:
+            # TSP takes one chunk of Lua per line, SCPI ; separated commands
+            separator = "\n" if self.language == "TSP" else ";"
+            for command in message.strip().split(separator):
+                command = command.strip()
+                if command:
+                    self.written.append(command)
+                    self.execute(command)
+        return len(message)
+
+    def read_raw(self):
+        with self.lock:
+            if not self.output:
+                raise IOError("VI_ERROR_TMO: no answer pending")
+            answer = self.output.pop(0)
+        # queries on the running sweep only answer when it is over
+        if isinstance(answer, tuple):
+            wait, answer = answer
+            time.sleep(max(0, wait-time.time()))
+        self.transfer(len(answer))
+        return answer
+
+    def read(self):
+        return self.read_raw().decode("ascii").rstrip("\n")
+
+    def query(self, message):
+        self.write(message)
+        return self.read()
+
+    def query_ascii_values(self, message, converter='f', separator=',', container=list):
+        self.write(message)
+        text = self.read()
+        return container([float(v) for v in text.split(separator) if v.strip()])
+
+    def query_binary_values(self, message, datatype='f', is_big_endian=False, container=list, header_fmt='ieee'):
+        self.write(message)
+        return self.read_binary_values(datatype, is_big_endian, container, header_fmt)
+
+    def read_binary_values(self, datatype='f', is_big_endian=False, container=list, header_fmt='ieee'):
+        block = self.read_raw()
+        if not block.startswith(b"#"):
+            raise ValueError("Expected a binary block, got %r" % block[:20])
+        ndigits = int(block[1:2])
+        length  = int(block[2:2+ndigits]) if ndigits else len(block)-2-1
+        payload = block[2+ndigits:2+ndigits+length]
+        order   = ">" if is_big_endian else "<"
+        return container(np.frombuffer(payload, dtype=order+datatype).astype(float))
+
+    def read_stb(self):
+        self.transfer(1)
+        with self.lock:
+            self.updateStatus(time.time())
+            stb = 0
+            if self.output and not (isinstance(self.output[0], tuple) and self.output[0][0] > time.time()):
+                stb |= 16                              # MAV, once the answer is ready
+            if self.esr & self.ese: stb |= 32          # ESB
+            return stb
+
+    def clear(self):
+        self.transfer(1)
+        with self.lock:
+            self.output = []
+
+    def close(self):
+        pass
+
+    #---------------------------------------------------------------------------------
+    # command parsing
+    def answer(self, text, wait=0):
+        if isinstance(text, str): text = (text+"\n").encode("ascii")
+        self.output.append((wait, text) if wait else text)
+
+    def execute(self, command):
+        time.sleep(self.commandTime)
+        now = time.time()
+        self.updateStatus(now)
+
+        if self.language == "TSP" and not command.startswith("*"):
+            self.executeTSP(command, now)
+            return
+
+        parts  = command.split(None, 1)
+        header = parts[0]
+        args   = [a.strip() for a in parts[1].split(",")] if len(parts) > 1 else []
+        query  = header.endswith("?")
+        if header.startswith("*"):
+            key = header.upper()
+        else:
+            key = ":".join(shortForm(n) for n in header.rstrip("?").lstrip(":").split(":"))
+            if query: key += "?"
+
+        if key == "*RST":
+            time.sleep(self.resetTime)
+            self.reset()
+        elif key == "*CLS":
+            self.esr = 0
+            self.opcArmed = 0
+            self.errors = []
+        elif key == "*IDN?":
+            self.answer("KEITHLEY INSTRUMENTS,MODEL 2450,%s,1.7.0b" % self.serial)
+        elif key == "*ESE":
+            self.ese = int(args[0])
+        elif key == "*ESE?":
+            self.answer("%i" % self.ese)
+        elif key == "*ESR?":
+            self.answer("%i" % self.esr)
+            self.esr = 0
+        elif key == "*OPC":
+            self.opcArmed = 1
+            self.updateStatus(now)
+        elif key == "*OPC?":
+            self.answer("1", wait=self.sweepEnd)
+        elif key == "*LANG?":
+            self.answer(self.language)
+        elif key == "SYST:ERR?":
+            self.answer(self.errors.pop(0) if self.errors else "0,\"No error\"")
+        elif key in self.settings:
+            self.settings[key] = args[0].upper()
+        elif key[:-1] in self.settings and query:
+            self.answer(self.settings[key[:-1]])
+        elif key == "SOUR:SWE:VOLT:LIN":
+            start, stop, points, delay = float(args[0]), float(args[1]), int(args[2]), float(args[3])
+            self.sweep = (np.linspace(start, stop, points), delay)
+        elif key == "SOUR:LIST:VOLT":
+            self.sourceList = np.array([float(a) for a in args])
+        elif key == "SOUR:LIST:VOLT:APP":
+            self.sourceList = np.append(self.sourceList, [float(a) for a in args])
+        elif key == "SOUR:SWE:VOLT:LIST":
+            start, delay = int(args[0]), float(args[1]) if len(args) > 1 else 0.0
+            if start < 1 or start > self.sourceList.size:
+                self.error(-222, "Data out of range; list index %i of %i" % (start,self.sourceList.size))
+                return
+            self.sweep = (self.sourceList[start-1:].copy(), delay)
+        elif key == "TRIG:LOAD":
+            # only the SimpleLoop model: count readings at the source level, delay apart
+            if args[0].strip('"').upper() != "SIMPLELOOP":
+                self.error(-224, "Illegal parameter value; "+args[0])
+                return
+            count, delay = int(args[1]), float(args[2]) if len(args) > 2 else 0.0
+            self.sweep = (np.full(count, float(self.settings["SOUR:VOLT"])), delay)
+        elif key == "INIT":
+            self.initiate(now)
+        elif key == "ABOR":
+            self.abort(now)
+        elif key == "OUTP":
+            self.outputOn = 1 if args[0].upper() in ("ON","1") else 0
+        elif key == "OUTP?":
+            self.answer("%i" % self.outputOn)
+        elif key == "TRAC:CLE":
+            self.clearBuffer()
+        elif key == "TRAC:ACT?":
+            self.answer("%i" % self.count(now))
+        elif key == "TRAC:DATA?":
+            self.answer(self.traceData(args, now))
+        else:
+            self.error(-113, "Undefined header; "+command)
+
+    # the few TSP statements the driver sends
+    def executeTSP(self, line, now):
+        if self.loading is not None:
+            if line == "endscript":
+                self.scripts[self.loading[0]] = self.loading[1]
+                self.loading = None
+            else:
+                self.loading[1].append(line)
+            return
+
+        loadscript = re.match(r"loadscript\s+(\w+)$", line)
+        run        = re.match(r"(\w+)\.run\(\)$", line)
+        call       = re.match(r"(\w+)\((.*)\)$", line)
+        if loadscript:
+            self.loading = (loadscript.group(1), [])
+        elif run:
+            if run.group(1) not in self.scripts:
+                self.error(-286, "TSP Runtime error; attempt to index a nil value "+run.group(1))
+                return
+            for scriptLine in self.scripts[run.group(1)]:
+                function = re.match(r"function\s+(\w+)\s*\(", scriptLine)
+                if function: self.functions.add(function.group(1))
+        elif line == "trigger.model.abort()":
+            self.abort(now)
+        elif line.replace(" ","") in ("smu.source.output=smu.OFF", "smu.source.output=smu.ON"):
+            self.outputOn = 1 if line.endswith("ON") else 0
+        elif call and call.group(1) == "k2450sweep":
+            if "k2450sweep" not in self.functions:
+                self.error(-286, "TSP Runtime error; attempt to call a nil value k2450sweep")
+                return
+            self.tspSweep([a.strip() for a in call.group(2).split(",")], now)
+        else:
+            self.error(-285, "TSP Syntax error; "+line)
+
+    # k2450sweep(v0, v1, n, dt, withTimes, nplc, filterCount): sweep, switch
+    # the output off and print the buffer as one REAL64 block once the sweep
+    # is over
+    def tspSweep(self, args, now):
+        start, stop, points, delay = float(args[0]), float(args[1]), int(args[2]), float(args[3])
+        withTimes = len(args) > 4 and int(args[4]) == 1
+        if len(args) > 5: self.settings["SENS:CURR:NPLC"] = args[5]
+        if len(args) > 6:
+            self.settings["SENS:CURR:AVER"]      = "ON" if int(args[6]) > 1 else "OFF"
+            self.settings["SENS:CURR:AVER:COUN"] = args[6]
+        self.sweep = (np.linspace(start, stop, points), delay)
+        self.clearBuffer()
+        self.initiate(now)
+        columns = [self.bufV, self.bufI] + ([self.bufT] if withTimes else [])
+        payload = np.column_stack(columns).ravel().astype("<f8").tobytes()
+        length  = "%i" % len(payload)
+        self.answer(("#%i%s" % (len(length),length)).encode("ascii") + payload + b"\n", wait=self.sweepEnd)
+
+    # TRAC:DATA? first, last, "buffer", elements...
+    def traceData(self, args, now):
+        first, last = int(args[0]), int(args[1])
+        if first < 1 or last < first or last > self.count(now):
+            self.error(-222, "Data out of range; %i..%i of %i" % (first,last,self.count(now)))
+            return ""
+        columns = {"SOUR": self.bufV, "READ": self.bufI, "REL": self.bufT}
+        elements = [e.upper() for e in args[3:]] or ["READ"]
+        for e in elements:
+            if e not in columns: self.error(-224, "Illegal parameter value; "+e)
+        values = np.column_stack([columns[e][first-1:last] for e in elements if e in columns]).ravel()
+
+        if self.settings["FORM:DATA"].startswith("REAL"):
+            order   = "<" if self.settings["FORM:BORD"].startswith("SWAP") else ">"
+            payload = values.astype(order+"f8").tobytes()
+            length  = "%i" % len(payload)
+            return ("#%i%s" % (len(length),length)).encode("ascii") + payload + b"\n"
+        return ",".join("%.6e" % v for v in values)
+
+
+
+# stands in for visa.ResourceManager with n simulated instruments. Extra
+# keyword arguments are passed on to every sim_2450
+class sim_resource_manager():
+
+    def __init__(self, n=1, **simArgs):
+        self.simArgs   = simArgs
+        self.resources = ["USB0::0x05E6::0x2450::SIM%05i::INSTR" % i for i in range(n)]
+        self.opened    = {}
+
+    def list_resources(self, query='?*::INSTR'):
+        pattern = query.replace("?*", "*")
+        return tuple(r for r in self.resources if fnmatch.fnmatch(r, pattern))
+
+    def open_resource(self, name):
+        if name not in self.resources:
+            raise IOError("VI_ERROR_RSRC_NFOUND: "+name)
+        if name not in self.opened:
+            self.opened[name] = sim_2450(name, **self.simArgs)
+        return self.opened[name]
+
+
+
+# sweeps of the real driver against a simulated unit, each compared with the
+# voltages it should have run. Returns the number of failed checks
+def checkDriver(log=print):
+    from keithley_2450_core import data, keithley_2450
+
+    rm   = sim_resource_manager(1, lineFreq=5000)
+    inst = keithley_2450(rm.list_resources()[0], rm)
+    inst.lineFreq = 5000
+    inst.connect()
+    unit = rm.open_resource(rm.list_resources()[0])
+    inst.parV0, inst.parV1, inst.parST, inst.parDT = 20, 30, 40, 0.001
+
+    failed = [0]
+    def check(name, ok, detail=""):
+        log("%-50s %s" % (name, "ok" if ok else "FAILED "+detail))
+        if not ok: failed[0] += 1
+
+    def sweep(adaptive, points):
+        inst.adaptive, inst.parST = adaptive, points
+        d = data()
+        if inst.measureIV(d) != 1: raise IOError(inst.logMessage)
+        return d
+
+    # a fine point that repeats another voltage is dropped: the curve has
+    # distinct voltages, a few less than parST at most
+    def distinct(d, points):
+        return points-2 <= d.V.size <= points and np.all(np.diff(d.V) > 0)
+
+    d = sweep(0, 40)
+    check("linear sweep", d.V.size == 40 and np.allclose(d.V, np.linspace(20, 30, 40)))
+    # the list sweep replaces the linear one on the instrument, the same
+    # linear sweep must be sent again afterwards
+    for k in range(2):
+        d = sweep(1, 40)
+        check("adaptive sweep %i" % (k+1), distinct(d, 40) and d.V.min() == 20 and d.V.max() == 30,
+              "%i points, V %g..%g" % (d.V.size, d.V.min(), d.V.max()))
+    d = sweep(0, 10)   # parST of the coarse pass of the last adaptive sweep
+    check("linear sweep after an adaptive one", np.allclose(d.V, np.linspace(20, 30, 10)),
+          "V %g..%g" % (d.V.min(), d.V.max()))
+
+    # a long list goes out in chunks
+    del unit.written[:]
+    d = sweep(1, inst.STmax)
+    lists = [c for c in unit.written if c.upper().startswith("SOUR:LIST:VOLT")]
+    check("adaptive sweep of %i points" % inst.STmax, distinct(d, inst.STmax) and d.V.min() == 20 and d.V.max() == 30,
+          "%i points" % d.V.size)
+    check("source list in chunks", len(lists) > 1 and all(c.count(",")+1 <= 100 for c in lists) and
+          all(c.upper().startswith("SOUR:LIST:VOLT:APP") for c in lists[1:]), "%i list commands" % len(lists))
+
+    # fine points rounded onto coarse voltages
+    inst.parV0, inst.parV1 = 0, 30
+    for points in (8, 10, 12):
+        d = sweep(1, points)
+        check("adaptive sweep of %i points over 0..30 V" % points, distinct(d, points),
+              "V %s" % ", ".join("%g" % v for v in d.V))
+
+    inst.disconnect()
+    return failed[0]
+
+
+
+if __name__ == "__main__":
+    sys.exit(1 if checkDriver() else 0)